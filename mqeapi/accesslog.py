@@ -0,0 +1,142 @@
+import atexit
+import logging
+import random
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+from flask import request, g
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+
+
+log = logging.getLogger('mqeapi')
+
+
+class AsyncLogWriter(object):
+    """Passes log records to handlers in a background thread, so that a blocked output
+    doesn't block the threads handling requests. When the queue of records is full,
+    the records are dropped. The thread is started on the first record, so that a
+    process forked after creating the writer starts its own thread."""
+
+    def __init__(self, queue_size):
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, handlers, record):
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        try:
+            self.queue.put_nowait((handlers, record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._write, name='mqeapi-log-writer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _write(self):
+        while True:
+            handlers, record = self.queue.get()
+            try:
+                for handler in handlers:
+                    if record.levelno >= handler.level:
+                        try:
+                            handler.handle(record)
+                        except Exception:
+                            # reported like by the logging module
+                            handler.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    def after_fork(self):
+        """Replace the queue copied from the parent process, which could be locked by
+        the parent's writer thread"""
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def flush(self, timeout=5):
+        """Wait at most ``timeout`` seconds until the queued records are written"""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline \
+                and self._thread is not None and self._thread.is_alive():
+            time.sleep(0.01)
+
+    def stats(self):
+        return OrderedDict([
+            ('depth', self.queue.qsize()),
+            ('dropped', self.dropped),
+        ])
+
+
+class QueueHandler(logging.Handler):
+    """A handler submitting records to an :class:`AsyncLogWriter`, which passes them to the
+    wrapped ``handlers``"""
+
+    def __init__(self, writer, handlers):
+        super(QueueHandler, self).__init__()
+        self.writer = writer
+        self.handlers = handlers
+
+    def emit(self, record):
+        try:
+            # the message arguments and the exception are formatted in the calling thread,
+            # the objects can change or be released later
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.writer.submit(self.handlers, record)
+        except Exception:
+            self.handleError(record)
+
+
+def setup_async_logging(queue_size):
+    """Replace the handlers of the configured loggers with :class:`QueueHandler` instances
+    writing to the original handlers in a background thread"""
+    writer = AsyncLogWriter(queue_size)
+    loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(l, logging.Logger)]
+    for logger in loggers:
+        if not logger.handlers or any(isinstance(h, QueueHandler) for h in logger.handlers):
+            continue
+        handlers = logger.handlers[:]
+        for h in handlers:
+            logger.removeHandler(h)
+        logger.addHandler(QueueHandler(writer, handlers))
+    metrics.queues.register('log', writer)
+    atexit.register(writer.flush)
+    global async_writer
+    async_writer = writer
+    return writer
+
+async_writer = None
+
+
+def request_started():
+    g.request_start_time = time.time()
+    g.access_log_sampled = random.random() < apiconfig.ACCESS_LOG_SAMPLE_RATE
+    if g.access_log_sampled and not apiconfig.ACCESS_LOG_COMBINED:
+        log.info('HTTP_START %s %s', request.method, request.url)
+
+def request_finished(response):
+    """Log the request unless it's not sampled. Failed and slow requests are always logged."""
+    duration_ms = (time.time() - g.request_start_time) * 1000
+    if not (g.access_log_sampled or response.status_code >= 400
+            or duration_ms >= apiconfig.ACCESS_LOG_SLOW_MS):
+        return
+    if apiconfig.ACCESS_LOG_COMBINED:
+        log.info('HTTP %s %s %s (%.1f) %s %s', request.method, request.url, response.status_code,
+                 duration_ms, request.remote_addr, response.calculate_content_length())
+    else:
+        log.info('HTTP_END %s %s %s (%.1f)', request.method, request.url,
+                 response.status_code, duration_ms)
@@ -0,0 +1,122 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+
+
+class Rejection(object):
+    """The reason of not admitting a request"""
+
+    def __init__(self, status, reason, message, retry_after):
+        self.status = status
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _OwnerState(object):
+
+    __slots__ = ('tokens', 'updated', 'in_flight')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.in_flight = 0
+
+
+class AdmissionController(object):
+    """Per-owner token-bucket rate limits and concurrency limits, kept in memory of
+    a process. ``None`` disables a limit.
+
+    :param rate: the number of requests per second an owner can make in the long run
+    :param burst: the capacity of an owner's token bucket
+    :param owner_concurrency: the maximal number of requests of an owner handled at once
+    :param total_concurrency: the maximal number of requests handled at once by the process
+    """
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, rate=None, burst=None, owner_concurrency=None, total_concurrency=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.owner_concurrency = owner_concurrency
+        self.total_concurrency = total_concurrency
+        self.in_flight = 0
+        self._owners = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+
+    def admit(self, owner_id, cost=1):
+        """Admit a request of the owner, returning ``None``, or return a :class:`Rejection`.
+        An admitted request must be followed by a call of :meth:`release`."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._prune(now)
+            st = self._owners.get(owner_id)
+            if st is None:
+                st = self._owners[owner_id] = _OwnerState(self.burst, now)
+
+            if self.total_concurrency is not None and self.in_flight >= self.total_concurrency:
+                return Rejection(503, 'overloaded', 'The server is overloaded', 1)
+            if self.owner_concurrency is not None and st.in_flight >= self.owner_concurrency:
+                return Rejection(429, 'concurrency',
+                                 'Too many concurrent requests (the limit is %s)' % self.owner_concurrency, 1)
+            if self.rate:
+                st.tokens = min(self.burst, st.tokens + (now - st.updated) * self.rate)
+                st.updated = now
+                if st.tokens < cost:
+                    retry_after = int(math.ceil((cost - st.tokens) / self.rate))
+                    return Rejection(429, 'rate', 'Request rate limit exceeded (%s requests per second)'
+                                     % self.rate, max(1, retry_after))
+                st.tokens -= cost
+
+            st.in_flight += 1
+            self.in_flight += 1
+            return None
+
+    def release(self, owner_id):
+        with self._lock:
+            st = self._owners.get(owner_id)
+            if st is not None and st.in_flight > 0:
+                st.in_flight -= 1
+                self.in_flight -= 1
+
+    def owner_in_flight(self, owner_id):
+        st = self._owners.get(owner_id)
+        return st.in_flight if st is not None else 0
+
+    def _prune(self, now):
+        # owners without requests in progress and with a full bucket have the initial state
+        for owner_id, st in self._owners.items():
+            refilled = not self.rate or st.tokens + (now - st.updated) * self.rate >= self.burst
+            if st.in_flight == 0 and refilled:
+                del self._owners[owner_id]
+        self._last_prune = now
+
+    def stats(self):
+        return OrderedDict([
+            ('inFlight', self.in_flight),
+            ('owners', len(self._owners)),
+            ('busyOwners', len([st for st in self._owners.values() if st.in_flight])),
+            ('maxOwnerInFlight', max([st.in_flight for st in self._owners.values()] or [0])),
+        ])
+
+
+REJECTED = metrics.Counter('mqeapi_admission_rejected_total',
+                           'The number of requests rejected by admission control', ('reason',))
+
+admission = metrics.StatsCollector('admission', [
+    ('inFlight', 'mqeapi_in_flight_requests', 'gauge', 'The number of requests being handled'),
+    ('busyOwners', 'mqeapi_in_flight_owners', 'gauge', 'The number of owners having requests being handled'),
+    ('maxOwnerInFlight', 'mqeapi_in_flight_requests_max_owner', 'gauge',
+     'The largest number of requests of a single owner being handled'),
+])
+
+controller = AdmissionController(apiconfig.OWNER_RATE_LIMIT, apiconfig.OWNER_RATE_BURST,
+                                 apiconfig.OWNER_MAX_CONCURRENT_REQUESTS, apiconfig.MAX_CONCURRENT_REQUESTS)
+
+admission.register('api', controller)
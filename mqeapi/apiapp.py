@@ -1,3 +1,9 @@
+import importlib
+import logging
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from flask import Flask
 
@@ -7,25 +13,92 @@ from mqe import util
 from mqeapi import apiconfig
 
 
+log = logging.getLogger('mqeapi.apiapp')
 
-def create():
-    if apiconfig.LOGGING_LEVEL:
-        util.setup_logging(apiconfig.LOGGING_LEVEL)
 
-    c.app = Flask(import_name=__name__)
-    c.app.config.from_object(apiconfig.FlaskSettings)
+#: the time (in seconds) of the steps of :func:`preload`
+startup_times = OrderedDict()
 
-    from mqeapi import appsetup
+@contextmanager
+def _startup_step(name):
+    start = time.time()
+    yield
+    startup_times[name] = time.time() - start
 
-    from mqeapi import views
-    c.app.register_blueprint(views.bp_api)
 
-    from mqeweb import valdisplay
-    valdisplay.setup_custom_types()
+def preload():
+    """Create the WSGI app without initializing the per-process state, which must be done
+    by calling :func:`post_fork` in each worker process. The function does the imports and
+    the configuration, so it can be called once by the master process of a preforking
+    server (like ``gunicorn --preload``), sharing the loaded modules with the workers."""
+    with _startup_step('logging'):
+        if apiconfig.LOGGING_LEVEL:
+            util.setup_logging(apiconfig.LOGGING_LEVEL)
+            if apiconfig.LOGGING_ASYNC:
+                from mqeapi import accesslog
+                accesslog.setup_async_logging(apiconfig.LOGGING_QUEUE_SIZE)
 
-    from mqe.dao.daoregistry import register_dao_modules_from_config
-    register_dao_modules_from_config(apiconfig)
+    with _startup_step('flask'):
+        c.app = Flask(import_name=__name__)
+        c.app.config.from_object(apiconfig.FlaskSettings)
+
+    with _startup_step('mqeapi.appsetup'):
+        from mqeapi import appsetup
+
+    with _startup_step('mqeapi.views'):
+        from mqeapi import views
+        c.app.register_blueprint(views.bp_api)
+
+    with _startup_step('mqeweb.valdisplay'):
+        from mqeweb import valdisplay
+        valdisplay.setup_custom_types()
+
+    # the DAO modules are only imported here and are registered by post_fork, so that
+    # the database connections are created in the worker processes
+    with _startup_step('dao_modules'):
+        from mqe import mqeconfig
+        for database_type, module_name in apiconfig.DAO_MODULES:
+            if database_type == mqeconfig.DATABASE_TYPE:
+                importlib.import_module(module_name)
+
+    from mqeapi import metrics
+    for step, duration in startup_times.items():
+        metrics.STARTUP_DURATION.set(duration, step=step)
+    log.info('App preloaded in %.3fs: %s', sum(startup_times.values()),
+             ', '.join('%s %.3fs' % item for item in startup_times.items()))
 
     return c.app
 
 
+def post_fork():
+    """Initialize the state of a worker process. Background threads (of queues, jobs and
+    thread pools) are started on the first use in the process."""
+    # the workers would otherwise sample the same requests
+    random.seed()
+
+    # the DAO objects and their database connections are created in each worker process,
+    # also when the parent process used the database before forking (like bench_api does)
+    _register_dao()
+
+    from mqeapi import accesslog
+    if accesslog.async_writer is not None:
+        accesslog.async_writer.after_fork()
+
+    from mqeapi import cooperative
+    cooperative.setup()
+
+    # jobs interrupted by exited processes are resumed by the new ones
+    from mqeapi import jobs
+    jobs.after_fork()
+
+
+def _register_dao():
+    from mqe.dao.daoregistry import register_dao_modules_from_config
+    register_dao_modules_from_config(apiconfig)
+
+
+def create():
+    """Create the WSGI app in a process which handles requests"""
+    app = preload()
+    post_fork()
+    return app
@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded LRU cache with per-entry expiration. The cache is local
+    to a process - each worker of a multi-process server holds its own copy.
+
+    :param int max_size: the maximal number of entries kept in the cache
+    :param ttl: the default time-to-live of entries, in seconds (``None`` means no expiration)
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return OrderedDict([
+            ('size', len(self._data)),
+            ('maxSize', self.max_size),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('invalidations', self.invalidations),
+            ('hitRatio', float(self.hits) / total if total else None),
+        ])
@@ -20,6 +20,21 @@ class FlaskSettings(object):
 # configuring the logging.
 LOGGING_LEVEL = 'INFO'
 
+# Whether log records are written by a background thread, so that a blocked output
+# doesn't block request handling. When more than LOGGING_QUEUE_SIZE records are waiting,
+# new records are dropped.
+LOGGING_ASYNC = False
+LOGGING_QUEUE_SIZE = 10000
+
+# Whether a single access log line is written at the end of a request, instead of
+# the HTTP_START and HTTP_END lines
+ACCESS_LOG_COMBINED = False
+
+# The fraction of successful requests which are logged. Requests failed with a 4xx or 5xx
+# status and requests slower than ACCESS_LOG_SLOW_MS milliseconds are always logged.
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_SLOW_MS = 1000
+
 
 # Data sizes limits
 
@@ -29,12 +44,273 @@ DEFAULT_GET_LIMIT = 20
 # The maximal number of returned items (for more items, paging is used)
 MAX_GET_LIMIT = 100
 
+# The maximal number of returned items when a response is streamed
+MAX_STREAM_GET_LIMIT = 10000
+
+# The number of items fetched from the database at once when a response is streamed
+STREAM_FETCH_SIZE = 20
+
+# The number of items fetched from the database at once when report instances are exported
+EXPORT_FETCH_SIZE = 100
+
 # The limits of lengths of fields like tag values or report names
 SIMPLE_VALUE_LEN_LIMIT = 200
 
 # The limit of lengths of data sizes supplied by users, like custom metadata
 USER_VALUE_LEN_LIMIT = 5000
 
+# The maximal number of items submitted in a single batch request
+MAX_BATCH_ITEMS = 1000
+
+# The maximal number of report instance ids passed to a single request
+MAX_GET_IDS = 100
+
+# The maximal number of reports for which the /latest endpoint returns instances
+MAX_LATEST_REPORTS = 100
+
+# The number of threads of a process used for fetching data of multiple reports
+# concurrently (by the /latest endpoint) and the maximal time (in seconds) of
+# waiting for the results
+FANOUT_THREADS = 8
+FANOUT_TIMEOUT = 30
+
+# The maximal number of report instances counted by the /instances/stats endpoint
+MAX_STATS_INSTANCES = 1000000
+
+# The number of instance ids fetched from the database at once by the /instances/stats endpoint
+STATS_FETCH_SIZE = 1000
+
+
+# Compression
+
+# The maximal size of a decompressed request body sent with Content-Encoding gzip or deflate
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# Whether responses are compressed with gzip when a client sends Accept-Encoding: gzip
+COMPRESS_RESPONSES = True
+
+# The minimal size of a response body to compress, in bytes. Streamed responses are
+# always compressed.
+COMPRESS_MIN_SIZE = 1024
+
+# The gzip compression level, from 1 (fastest) to 9 (best compression)
+COMPRESS_LEVEL = 6
+
+
+# API key cache
+
+# The maximal number of API keys for which the owner is cached in a worker process.
+# Setting 0 disables the cache.
+API_KEY_CACHE_SIZE = 10000
+
+# The number of seconds for which a valid API key is cached. A revoked API key can
+# be accepted for this long by workers which don't receive an explicit invalidation.
+API_KEY_CACHE_TTL = 60
+
+# The number of seconds for which an invalid API key is cached
+API_KEY_CACHE_NEGATIVE_TTL = 5
+
+
+# Report cache
+
+# The maximal number of reports (looked up by an owner and a name) cached in a worker
+# process. Setting 0 disables the cache.
+REPORT_CACHE_SIZE = 10000
+
+# The number of seconds for which a report is cached. A report deleted by another
+# process can be seen as existing for this long.
+REPORT_CACHE_TTL = 60
+
+# The number of seconds for which a cached report is used for creating report instances.
+# Report instances created by a process in a report which another process deleted in
+# the meantime are lost, so the value should be short. Setting 0 disables the cache
+# for creating report instances.
+REPORT_CACHE_INSERT_TTL = 2
+
+
+# Input type memo
+
+# The maximal number of reports for which the input type that succeeded for the recent input
+# is remembered. When the format of an input is not specified, the remembered type is tried
+# first instead of guessing the format. Setting 0 disables the memo.
+INPUT_TYPE_MEMO_SIZE = 10000
+
+# The number of seconds for which an input type is remembered
+INPUT_TYPE_MEMO_TTL = 600
+
+
+# HTTP caching
+
+# The Cache-Control header of a single report instance, which never changes after creation
+INSTANCE_CACHE_CONTROL = 'private, max-age=86400'
+
+# The Cache-Control header of a list of report instances, which must be revalidated
+# using the ETag
+LISTING_CACHE_CONTROL = 'private, no-cache'
+
+
+# Response cache
+
+# Whether responses listing report instances are cached on the server side
+RESPONSE_CACHE_ENABLED = False
+
+# The class of the store of cached responses. The default store keeps the responses
+# in the memory of a worker process, in which case the responses are invalidated only
+# by writes made through the same process, and other processes can return stale
+# responses for RESPONSE_CACHE_TTL seconds.
+RESPONSE_CACHE_STORE = 'mqeapi.responsecache.LocalStore'
+
+# The maximal total size of cached responses in a store, in bytes
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# The number of seconds for which a response is cached
+RESPONSE_CACHE_TTL = 10
+
+
+# Asynchronous ingestion
+
+# Whether POST /reports/<name> enqueues the input for asynchronous processing when
+# the query parameter async is not passed
+ASYNC_INGEST_DEFAULT = False
+
+# The maximal number of inputs waiting for processing in a worker process. When the
+# queue is full, the 503 status is returned.
+ASYNC_INGEST_QUEUE_SIZE = 1000
+
+# The number of threads processing the queued inputs in a worker process
+ASYNC_INGEST_WORKERS = 4
+
+# The value of the Retry-After header returned when the queue is full, in seconds
+ASYNC_INGEST_RETRY_AFTER = 5
+
+# The maximal number of seconds spent on processing the queued inputs when a worker
+# process exits
+ASYNC_INGEST_DRAIN_TIMEOUT = 30
+
+
+# Watching new report instances
+
+# The default and the maximal time (in seconds) a long-polling watch request waits for
+# new report instances
+WATCH_DEFAULT_TIMEOUT = 30
+WATCH_MAX_TIMEOUT = 60
+
+# The interval (in seconds) of checking the database for new report instances by a waiting
+# request. Instances created by the same process wake waiting requests immediately, the
+# interval matters for instances created by other processes
+WATCH_RECHECK_INTERVAL = 5
+
+# The time (in seconds) after which a server-sent events stream is closed (a client
+# reconnects with the Last-Event-ID header) and the interval of heartbeat comments
+WATCH_SSE_MAX_DURATION = 300
+WATCH_SSE_HEARTBEAT = 15
+
+
+# Paging
+
+# The secret used (along with the client's API key) for signing cursors of paged listings.
+# Must be the same for all processes of the server. With an empty secret a client can
+# create cursors itself (their state is validated like query parameters)
+CURSOR_SECRET = ''
+
+# Whether the next page of a listing paged with a cursor is fetched in the background
+# before the client requests it. Prefetched pages can miss changes made during
+# CURSOR_PREFETCH_TTL seconds
+CURSOR_PREFETCH = False
+
+# The time (in seconds) for which a prefetched page is kept
+CURSOR_PREFETCH_TTL = 10
+
+# The maximal number of kept prefetched pages
+CURSOR_PREFETCH_CACHE_SIZE = 100
+
+# The number of threads prefetching pages and the maximal number of waiting prefetches
+CURSOR_PREFETCH_WORKERS = 2
+CURSOR_PREFETCH_QUEUE_SIZE = 100
+
+
+# Background jobs
+
+# Deletes of more report instances are executed by background jobs, tracked
+# by the /jobs/<id> endpoint
+DELETE_SYNC_LIMIT = 200
+
+# The number of report instances deleted by a job at once
+DELETE_CHUNK_SIZE = 500
+
+# The pause between deleting chunks, in seconds
+DELETE_CHUNK_PAUSE = 0.05
+
+# The number of threads executing jobs
+JOB_WORKERS = 1
+
+# The maximal number of jobs waiting for execution
+JOB_QUEUE_SIZE = 100
+
+# The class of the store keeping the state of jobs, shared by the processes of the server.
+# The default store keeps files in JOB_STORE_DIR, shared by the processes of a single host.
+# A store shared by multiple hosts must implement the interface of mqeapi.jobs.FileStore
+JOB_STORE = 'mqeapi.jobs.FileStore'
+
+# The directory of the default job store (None means mqeapi-jobs in the system's
+# temporary directory). Servers using different databases must use different directories
+JOB_STORE_DIR = None
+
+# The time (in seconds) for which finished jobs are kept
+JOB_TTL = 24 * 3600
+
+# The time (in seconds) for which a process caches the set of reports being deleted by jobs.
+# A report deleted by a job of another process can be seen as existing for this long, and
+# report instances created in the meantime can be lost, so the value should be short
+JOB_HIDDEN_REPORTS_TTL = 1
+
+# The time (in seconds) the process waits on exit for the running jobs to stop. Interrupted
+# jobs are resumed by another process
+JOB_DRAIN_TIMEOUT = 5
+
+
+# Cooperative mode
+
+# Set to True when running the app by a gevent server (like gunicorn -k gevent). Database
+# calls and parsing inputs are then executed by a pool of COOPERATIVE_DAO_THREADS threads,
+# while a worker process can keep thousands of connections (see --worker-connections)
+COOPERATIVE_MODE = False
+
+# The number of threads of a process executing database calls in the cooperative mode.
+# It limits the number of concurrent database calls of a process
+COOPERATIVE_DAO_THREADS = 16
+
+
+# Admission control. The limits are local to a process. None disables a limit. Watch
+# requests waiting for new report instances don't count against the concurrency limits.
+
+# The number of requests per second an owner can make in the long run
+OWNER_RATE_LIMIT = None
+
+# The number of requests an owner can make at once before being rate-limited
+# (None means OWNER_RATE_LIMIT)
+OWNER_RATE_BURST = None
+
+# The maximal number of requests of an owner handled at the same time. Additional
+# requests get the 429 status
+OWNER_MAX_CONCURRENT_REQUESTS = None
+
+# The maximal number of requests handled at the same time. Additional requests get
+# the 503 status
+MAX_CONCURRENT_REQUESTS = None
+
+
+# Metrics
+
+# Whether the /metrics endpoint returning metrics in the Prometheus text format is enabled
+METRICS_ENABLED = False
+
+# The client addresses allowed to fetch /metrics (the endpoint doesn't use API keys).
+# X-Forwarded-For headers are not taken into account, so behind a reverse proxy running
+# on the same host all clients have the proxy's address - the proxy must then block
+# the /metrics path.
+METRICS_ALLOWED_ADDRS = ['127.0.0.1', '::1']
+
 
 # Monique API uses UserDAO from Monique Web
 DAO_MODULES = [
@@ -1,15 +1,29 @@
 import uuid
 import urlparse
 import urllib
+import hashlib
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 
 from flask import g, request
+from werkzeug import http
 
 from mqetables import enrichment
+from mqetables import parseany
+from mqe import c
 from mqe import util
 from mqe import reports
 from mqe import serialize
 
 from mqeapi import apiconfig
+from mqeapi import apicache
+from mqeapi import admission
+from mqeapi import cursors
+from mqeapi import jobs
+from mqeapi import cooperative
+from mqeapi.cooperative import offload
+from mqeapi import metrics
 from mqeapi import responses
 
 
@@ -23,6 +37,13 @@ def set_query_param(url, param_name, param_value):
 def href(path):
     return apiconfig.BASE_URL_API + path
 
+def cursor_href(path, state):
+    """Return a link to the ``path`` continuing a listing with a cursor encoding the ``state``"""
+    params = [('cursor', cursors.encode(state, g.api_key))]
+    if request.args.get('key'):
+        params.append(('key', request.args['key'].encode('utf-8')))
+    return href(path) + '?' + urllib.urlencode(params)
+
 def to_id(uuid):
     return uuid.hex
 
@@ -103,6 +124,65 @@ def parse_enum(s, enum_values):
             val, ', '.join('<%s>' % ev for ev in enum_values)))
     return val
 
+# the types of values of a cursor state, by the keys
+CURSOR_VALUE_TYPES = {
+    'p': basestring, 'n': basestring, 'a': basestring, 'b': basestring, 'o': basestring,
+    'f': (int, long), 't': (int, long), 'l': (int, long),
+    'e': bool, 'i': bool, 's': bool,
+    'g': list, 'fl': list,
+}
+
+def _valid_cursor_state(state, required):
+    if any(state.get(key) is None for key in required):
+        return False
+    for key, types in CURSOR_VALUE_TYPES.items():
+        if state.get(key) is not None and not isinstance(state[key], types):
+            return False
+    max_limit = apiconfig.MAX_STREAM_GET_LIMIT if state.get('s') else apiconfig.MAX_GET_LIMIT
+    if not 1 <= state['l'] <= max_limit:
+        return False
+    if state.get('o') not in (None, 'asc', 'desc'):
+        return False
+    if not all(isinstance(v, basestring) for v in state.get('g') or []):
+        return False
+    if not all(v in INSTANCE_FIELDS for v in state.get('fl') or []):
+        return False
+    try:
+        for key in ('a', 'b'):
+            if state.get(key):
+                uuid.UUID(state[key])
+        for key in ('f', 't'):
+            cursors.micros_to_dt(state.get(key))
+    except (ValueError, OverflowError):
+        return False
+    return True
+
+def parse_cursor(s, kind, name=None, required=('l',)):
+    """Return the state encoded in a cursor created for a listing of the ``kind``
+    (and of the report ``name``). The state is validated like query parameters, because
+    with an empty ``CURSOR_SECRET`` a client can sign a cursor itself. The ``required``
+    keys must have values."""
+    state = cursors.decode(s, g.api_key)
+    if state is None or state.get('k') != kind or state.get('r') != name \
+            or not _valid_cursor_state(state, required):
+        raise responses.ExceptionalResponse.bad_request('Invalid cursor')
+    return state
+
+INSTANCE_FIELDS = ('id', 'created', 'tags', 'rows', 'header', 'input', 'href')
+
+def parse_fields(s):
+    """Parse a comma-separated list of report instance attributes. Returns ``None``
+    when all attributes should be returned."""
+    val = parse_string(s)
+    if not val:
+        return None
+    fields = [f.strip() for f in val.split(',') if f.strip()]
+    for f in fields:
+        if f not in INSTANCE_FIELDS:
+            raise responses.ExceptionalResponse.bad_request('Invalid field <%s>, must be one of: %s' % (
+                f, ', '.join('<%s>' % ef for ef in INSTANCE_FIELDS)))
+    return set(fields)
+
 def parse_json(s):
     if not s or not s.strip():
         return None
@@ -112,27 +192,223 @@ def parse_json(s):
         raise responses.ExceptionalResponse.bad_request('Invalid json value <%s>' % s)
 
 
+api_key_cache = apicache.LRUCache(apiconfig.API_KEY_CACHE_SIZE, apiconfig.API_KEY_CACHE_TTL)
+metrics.caches.register('apiKey', api_key_cache)
+
+_NOT_CACHED = object()
+
+def select_owner_id(api_key):
+    """Return the owner id of the passed API key or ``None`` if the key is invalid.
+    Both results are cached in :data:`api_key_cache`."""
+    owner_id = api_key_cache.get(api_key, _NOT_CACHED)
+    if owner_id is not _NOT_CACHED:
+        return owner_id
+    owner_id = offload(c.dao.ApiKeyDAO.select_user_id, api_key)
+    if owner_id is not None:
+        api_key_cache.put(api_key, owner_id)
+    elif apiconfig.API_KEY_CACHE_NEGATIVE_TTL:
+        api_key_cache.put(api_key, None, apiconfig.API_KEY_CACHE_NEGATIVE_TTL)
+    return owner_id
+
+def invalidate_api_key(api_key=None):
+    """Remove the API key from the cache, for example after it was revoked. If no key
+    is passed, all cached keys are removed."""
+    if api_key is None:
+        api_key_cache.clear()
+    else:
+        api_key_cache.invalidate(api_key)
+
+
+report_cache = apicache.LRUCache(apiconfig.REPORT_CACHE_SIZE, apiconfig.REPORT_CACHE_TTL)
+metrics.caches.register('report', report_cache)
+
+def select_report(owner_id, name):
+    """A cached version of :meth:`~mqe.reports.Report.select_by_name`. A report being
+    deleted by a job isn't returned."""
+    if report_being_deleted(owner_id, name):
+        return None
+    report = report_cache.get((owner_id, name))
+    if report is None:
+        with metrics.timed('report_lookup'):
+            report = offload(reports.Report.select_by_name, owner_id, name)
+        if report:
+            report_cache.put((owner_id, name), report)
+    return report
+
+def select_or_insert_report(owner_id, name):
+    """A cached version of :meth:`~mqe.reports.Report.select_or_insert`. Report instances
+    created in a report deleted by another process are lost, so the cached reports
+    are used for creating instances only for ``REPORT_CACHE_INSERT_TTL`` seconds."""
+    report = report_cache.get(('insert', owner_id, name))
+    if report is None:
+        with metrics.timed('report_lookup'):
+            report = offload(reports.Report.select_or_insert, owner_id, name)
+        if report:
+            report_cache.put(('insert', owner_id, name), report, apiconfig.REPORT_CACHE_INSERT_TTL)
+            report_cache.put((owner_id, name), report)
+    return report
+
+def invalidate_report(owner_id, name):
+    report_cache.invalidate((owner_id, name))
+    report_cache.invalidate(('insert', owner_id, name))
+
+def report_being_deleted(owner_id, name):
+    """Tell if the report is being deleted by a job. The job is resumed if the process
+    executing it has exited."""
+    job_id = jobs.hiding_job_id(owner_id, name)
+    if job_id is None:
+        return False
+    jobs.resume(job_id)
+    return True
+
+
+input_type_memo = apicache.LRUCache(apiconfig.INPUT_TYPE_MEMO_SIZE, apiconfig.INPUT_TYPE_MEMO_TTL)
+metrics.caches.register('inputType', input_type_memo)
+
+# input types parsing almost any input, which aren't remembered: trying them first
+# would parse inputs of a changed format with a wrong parser instead of guessing the format
+CATCH_ALL_INPUT_TYPES = ('single', 'markdown', 'tokens', 'props')
+
+def detected_input_type(ipres):
+    """Return the concrete input type (a key of ``parseany.INPUT_PARSERS``) which was used
+    for parsing an input submitted with the ``any`` type, taken from the result
+    of :meth:`~mqe.reports.Report.process_input`"""
+    return ipres.input_parse_result.input_type
+
+def remember_input_type(report, ipres):
+    """Remember the input type which succeeded for the input of the ``any`` type, unless
+    it's a catch-all type"""
+    input_type = detected_input_type(ipres)
+    if input_type in parseany.INPUT_PARSERS and input_type != 'any' \
+            and input_type not in CATCH_ALL_INPUT_TYPES:
+        input_type_memo.put(report.report_id, input_type)
+
+
 def get_report(name):
-    report = reports.Report.select_by_name(g.owner_id, name)
+    report = select_report(g.owner_id, name)
     if not report:
         raise responses.ExceptionalResponse(responses.ApiResponse(404, message='Report <%s> not found' % name))
     return report
 
 def get_report_instance(report, report_instance_id):
-    ri = report.fetch_single_instance(report_instance_id)
+    with metrics.timed('dao_fetch'):
+        ri = offload(report.fetch_single_instance, report_instance_id)
     if not ri:
         raise responses.ExceptionalResponse(responses.ApiResponse(404, message='Report instance with id <%s> not found' % to_id(report_instance_id)))
     return ri
 
-def get_limit():
+def iter_instances(report, from_dt=None, to_dt=None, tags=None, order='asc', after=None, before=None,
+                   limit=None, chunk_size=None, columns=None):
+    """Yield report instances, fetching them in chunks of ``chunk_size`` instances
+    (``MAX_GET_LIMIT`` by default). The arguments have the same meaning as for
+    :meth:`~mqe.reports.Report.fetch_instances`, ``limit=None`` means no limit."""
+    chunk_size = chunk_size or apiconfig.MAX_GET_LIMIT
+    fetched = 0
+    while limit is None or fetched < limit:
+        chunk_limit = chunk_size if limit is None else min(chunk_size, limit - fetched)
+        with metrics.timed('dao_fetch'):
+            instances = offload(report.fetch_instances, from_dt=from_dt, to_dt=to_dt,
+                                limit=chunk_limit, tags=tags, order=order, after=after,
+                                before=before, columns=columns)
+        for ri in instances:
+            yield ri
+        fetched += len(instances)
+        if len(instances) < chunk_limit:
+            return
+        if order == 'asc':
+            after = instances[-1].report_instance_id
+        else:
+            before = instances[-1].report_instance_id
+
+def has_more_instances(report, count, from_dt=None, to_dt=None, tags=None):
+    """Tell if more than ``count`` report instances match the arguments"""
+    with metrics.timed('dao_fetch'):
+        return len(offload(report.fetch_instances, from_dt=from_dt, to_dt=to_dt,
+                           limit=count + 1, tags=tags, columns=['report_instance_id'])) > count
+
+def delete_instances_in_chunks(report, from_dt=None, to_dt=None, tags=None, chunk_size=None):
+    """Delete report instances matching the arguments in chunks of about ``chunk_size``
+    (``DELETE_CHUNK_SIZE`` by default) instances, ordered by the creation datetime.
+    Yields the number of deleted instances after deleting a chunk."""
+    chunk_size = chunk_size or apiconfig.DELETE_CHUNK_SIZE
+    last_id = None
+    while True:
+        with metrics.timed('dao_fetch'):
+            instances = offload(report.fetch_instances, from_dt=from_dt, to_dt=to_dt,
+                                limit=chunk_size, tags=tags, columns=['report_instance_id'])
+        if not instances:
+            return
+        delete_rest = instances[-1].report_instance_id == last_id
+        if delete_rest:
+            # the previous chunk wasn't fully deleted, delete the rest at once
+            chunk_to_dt = to_dt
+        else:
+            chunk_to_dt = util.datetime_from_uuid1(instances[-1].report_instance_id)
+            if to_dt is not None:
+                chunk_to_dt = min(chunk_to_dt, to_dt)
+        last_id = instances[-1].report_instance_id
+        with metrics.timed('dao_delete'):
+            offload(report.delete_multiple_instances, from_dt=from_dt, to_dt=chunk_to_dt, tags=tags)
+        yield len(instances)
+        if delete_rest or len(instances) < chunk_size:
+            return
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def release_admission():
+    """Release the concurrency slot of the current request admitted by admission control.
+    A request waiting for a long time (like a watch request) then doesn't count against
+    the concurrency limits."""
+    if g.get('admitted'):
+        admission.controller.release(g.owner_id)
+        g.admitted = False
+
+def map_concurrently(fun, items):
+    """Return ``[fun(item) for item in items]``, executing the calls by a pool of
+    ``FANOUT_THREADS`` threads shared by all requests. The pool is created on the first
+    use in a process."""
+    global _pool, _pool_pid
+    if len(items) <= 1:
+        return map(fun, items)
+    if cooperative.enabled():
+        return cooperative.map_greenlets(fun, items, apiconfig.FANOUT_THREADS)
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(apiconfig.FANOUT_THREADS)
+            _pool_pid = os.getpid()
+    # waiting with a timeout keeps the waiting thread interruptible
+    return _pool.map_async(fun, items).get(apiconfig.FANOUT_TIMEOUT)
+
+def get_limit(max_limit=None):
+    if max_limit is None:
+        max_limit = apiconfig.MAX_GET_LIMIT
     limit = parse_int(request.args.get('limit'))
     if limit is None:
         limit = apiconfig.DEFAULT_GET_LIMIT
 
-    if not 1 <= limit <= apiconfig.MAX_GET_LIMIT:
-        raise responses.ExceptionalResponse(responses.ApiResponse(400, message='Invalid limit <%s>: must be between 1 and %s' % (limit, apiconfig.MAX_GET_LIMIT)))
+    if not 1 <= limit <= max_limit:
+        raise responses.ExceptionalResponse(responses.ApiResponse(400, message='Invalid limit <%s>: must be between 1 and %s' % (limit, max_limit)))
     return limit
 
+def etag_headers(etag, weak=False, cache_control=None):
+    headers = {'ETag': http.quote_etag(etag, weak)}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    return headers
+
+def is_not_modified(etag):
+    return request.if_none_match.contains_weak(etag)
+
+def listing_etag(instances):
+    """Compute an ETag of a response listing the report instances, based on the ids of the
+    instances and the query parameters of the request"""
+    h = hashlib.sha1(request.query_string)
+    for ri in instances:
+        h.update(ri.report_instance_id.bytes)
+    return h.hexdigest()
+
 def client_ip():
     ff = request.headers.get('x-forwarded-for')
     if not ff:
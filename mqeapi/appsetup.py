@@ -6,6 +6,12 @@ from flask import request_started, request_finished, request, abort, g
 from mqe import c
 
 from mqeapi import responses
+from mqeapi import apiutil
+from mqeapi import compression
+from mqeapi import metrics
+from mqeapi import apiconfig
+from mqeapi import accesslog
+from mqeapi import admission
 
 
 log = logging.getLogger('mqeapi')
@@ -13,16 +19,44 @@ log = logging.getLogger('mqeapi')
 
 @request_started.connect_via(c.app)
 def log_request_start(*args, **kwargs):
-    g.request_start_time = time.time()
-    log.info('HTTP_START %s %s', request.method, request.url)
+    accesslog.request_started()
 
 @request_finished.connect_via(c.app)
 def log_request_end(*args, **kwargs):
-    log.info('HTTP_END %s %s %s (%.1f)', request.method, request.url,
-             kwargs['response'].status_code, (time.time() - g.request_start_time) * 1000)
+    accesslog.request_finished(kwargs['response'])
+
+@request_finished.connect_via(c.app)
+def record_request_metrics(*args, **kwargs):
+    response = kwargs['response']
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = response.status_code
+    metrics.REQUESTS.inc(method=request.method, route=route, status=status)
+    metrics.REQUEST_DURATION.observe(time.time() - g.request_start_time,
+                                     method=request.method, route=route, status=status)
+    if request.content_length:
+        metrics.REQUEST_SIZE.observe(request.content_length, method=request.method, route=route)
+    if not response.is_streamed:
+        metrics.RESPONSE_SIZE.observe(response.calculate_content_length() or 0,
+                                      method=request.method, route=route)
+
+@c.app.after_request
+def compress_response(response):
+    return compression.compress_response(response)
 
 @request_started.connect_via(c.app)
 def authenticate_owner(*args, **kwargs):
+    if request.path == '/metrics':
+        if not apiconfig.METRICS_ENABLED:
+            abort(404)
+        if request.remote_addr not in apiconfig.METRICS_ALLOWED_ADDRS:
+            raise responses.ExceptionalResponse(responses.ApiResponse(403, message='Access to metrics not allowed'))
+        return
+
+    with metrics.timed('auth'):
+        _authenticate_owner_by_api_key()
+    _admit_request()
+
+def _authenticate_owner_by_api_key():
     def possible_api_keys():
         if request.authorization:
             yield request.authorization.get('username')
@@ -32,13 +66,30 @@ def authenticate_owner(*args, **kwargs):
     for api_key in possible_api_keys():
         if not api_key:
             continue
-        owner_id = c.dao.ApiKeyDAO.select_user_id(api_key)
+        owner_id = apiutil.select_owner_id(api_key)
         if owner_id is not None:
             g.owner_id = owner_id
             g.api_key = api_key
             return
     abort(401)
 
+def _admit_request():
+    rejection = admission.controller.admit(g.owner_id)
+    if rejection is not None:
+        admission.REJECTED.inc(reason=rejection.reason)
+        if rejection.status == 429:
+            resp = responses.too_many_requests(rejection.message, rejection.retry_after)
+        else:
+            resp = responses.service_unavailable(rejection.message, rejection.retry_after)
+        raise responses.ExceptionalResponse(resp)
+    g.admitted = True
+
+@c.app.teardown_request
+def release_request(exc):
+    # executed after a streamed response is consumed
+    if g.get('admitted'):
+        admission.controller.release(g.owner_id)
+
 
 @c.app.errorhandler(400)
 def error_400(e):
@@ -0,0 +1,301 @@
+"""A benchmark of the API endpoints, running the app in-process with Flask's test client
+against a SQLite3 database created in a temporary directory. For each scenario it reports
+requests per second, the p50/p99 latency and the memory usage. Each scenario is run by
+new processes forked after creating the data, because the peak memory usage of a process
+includes the earlier scenarios.
+Requires Monique Web in ``$PYTHONPATH``. Run with::
+
+    $ python -m mqeapi.bench_api
+    $ python -m mqeapi.bench_api --threads 4 --processes 2 --json bench.json
+    $ python -m mqeapi.bench_api --scenario post_json --scenario list_expand -n 1000
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from collections import OrderedDict
+
+
+INPUTS = OrderedDict([
+    ('json', json.dumps([OrderedDict([('name', 'monique'), ('points', 123)]),
+                         OrderedDict([('name', 'john'), ('points', 34)])])),
+    ('jsonraw', json.dumps([OrderedDict([('name', 'monique'), ('stats', OrderedDict([('points', 123)]))]),
+                            OrderedDict([('name', 'john'), ('stats', OrderedDict([('points', 34)]))])])),
+    ('csv', 'name,points\nmonique,123\njohn,34\n'),
+    ('ascii', '+---------+--------+\n| name    | points |\n+=========+========+\n'
+              '| monique | 123    |\n| john    | 34     |\n+---------+--------+\n'),
+    ('asciitable', '+---------+--------+\n| name    | points |\n+=========+========+\n'
+                   '| monique | 123    |\n| john    | 34     |\n+---------+--------+\n'),
+    ('asciispace', 'name      points\nmonique   123\njohn      34\n'),
+    ('props', 'name=monique\npoints=123\n'),
+    ('tokens', 'monique 123 john 34'),
+    ('markdown', '# Points\n\n* monique: 123\n* john: 34\n'),
+    ('single', 'monique has 123 points'),
+    ('any', 'Filesystem     1K-blocks    Used Available Use% Mounted on\n'
+            '/dev/sda1       41251136 9375272  29763544  24% /\n'
+            'tmpfs            1019292       0   1019292   0% /dev/shm\n'),
+])
+
+LISTED_REPORT = 'bench_listing'
+LISTED_INSTANCES = 500
+
+
+class Bench(object):
+    """Holds the app, an API key and the data created for the scenarios"""
+
+    def __init__(self, app, api_key):
+        self.app = app
+        self.api_key = api_key
+        self.instance_ids = []
+        self.first_page = None
+
+    def client(self):
+        return self.app.test_client()
+
+    def url(self, path, **params):
+        params['key'] = self.api_key
+        return path + '?' + urllib.urlencode(sorted(params.items()))
+
+    def prepare(self):
+        client = self.client()
+        for i in range(LISTED_INSTANCES):
+            r = client.post(self.url('/reports/%s' % LISTED_REPORT, tags='host:h%s' % (i % 5)),
+                            data=INPUTS['any'])
+            assert r.status_code == 200, r.data
+            self.instance_ids.append(json.loads(r.data)['result']['id'])
+        r = client.get(self.url('/reports/%s/instances' % LISTED_REPORT, limit=20))
+        self.first_page = json.loads(r.data)['details']['next']
+
+
+def _post_scenario(input_type):
+    def scenario(bench, client, i):
+        return client.post(bench.url('/reports/bench_post_%s' % input_type, format=input_type),
+                           data=INPUTS[input_type])
+    return scenario
+
+def list_expand(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances' % LISTED_REPORT, limit=100))
+
+def list_no_expand(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances' % LISTED_REPORT, limit=100, expand=0))
+
+def list_fields(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances' % LISTED_REPORT, limit=100, fields='id,created'))
+
+def list_tags(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances' % LISTED_REPORT, limit=100, tags='host:h1'))
+
+def page(bench, client, i):
+    # the next link is absolute, the test client needs the path
+    next_url = bench.first_page
+    return client.get(next_url[next_url.index('/reports/'):])
+
+def get_single(bench, client, i):
+    id = bench.instance_ids[i % len(bench.instance_ids)]
+    return client.get(bench.url('/reports/%s/instances/%s' % (LISTED_REPORT, id)))
+
+def get_ids(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances' % LISTED_REPORT,
+                                ids=','.join(bench.instance_ids[i % 400:i % 400 + 20])))
+
+def stats(bench, client, i):
+    return client.get(bench.url('/reports/%s/instances/stats' % LISTED_REPORT, bucket='hour'))
+
+def _create_deleted_instances(bench, client, count):
+    name = 'bench_delete_%s_%s' % (os.getpid(), threading.current_thread().ident)
+    ids = []
+    for i in range(count):
+        r = client.post(bench.url('/reports/%s' % name), data='1')
+        ids.append((name, json.loads(r.data)['result']['id']))
+    return ids
+
+def delete_single(bench, client, (name, id)):
+    return client.delete(bench.url('/reports/%s/instances/%s' % (name, id)))
+delete_single.setup = _create_deleted_instances
+
+def _create_deleted_reports(bench, client, count):
+    names = []
+    for i in range(count):
+        name = 'bench_delete_range_%s_%s_%s' % (os.getpid(), threading.current_thread().ident, i)
+        client.post(bench.url('/reports/%s/batch' % name), data=json.dumps(['1', '2', '3', '4', '5']))
+        names.append(name)
+    return names
+
+def delete_range(bench, client, name):
+    return client.delete(bench.url('/reports/%s/instances' % name))
+delete_range.setup = _create_deleted_reports
+
+SCENARIOS = OrderedDict([('post_%s' % input_type, _post_scenario(input_type))
+                         for input_type in INPUTS] + [
+    ('list_expand', list_expand),
+    ('list_no_expand', list_no_expand),
+    ('list_fields', list_fields),
+    ('list_tags', list_tags),
+    ('page', page),
+    ('get_single', get_single),
+    ('get_ids', get_ids),
+    ('stats', stats),
+    ('delete_single', delete_single),
+    ('delete_range', delete_range),
+])
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def max_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+_bench = None
+
+def _run_requests((scenario_name, count, threads)):
+    """Send ``count`` requests of the scenario using ``threads`` threads, returning
+    the latencies of successful requests, the number of errors, the time of sending
+    the requests, the peak memory usage and its growth during the scenario.
+
+    A scenario having a ``setup`` function creates its data (like the deleted report
+    instances) before the timing starts, getting the i-th item of the data instead
+    of ``i``."""
+    start_rss = max_rss_kb()
+    scenario = SCENARIOS[scenario_name]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    counts = [count // threads + (1 if t < count % threads else 0) for t in range(threads)]
+    setup = getattr(scenario, 'setup', None)
+    data = [setup(_bench, _bench.client(), n) if setup else range(n) for n in counts]
+
+    def work(items):
+        client = _bench.client()
+        for item in items:
+            start = time.time()
+            r = scenario(_bench, client, item)
+            duration = time.time() - start
+            with lock:
+                if r.status_code == 200:
+                    latencies.append(duration)
+                else:
+                    errors[0] += 1
+
+    workers = [threading.Thread(target=work, args=(items,)) for items in data]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+    max_rss = max_rss_kb()
+    return latencies, errors[0], elapsed, max_rss, max_rss - start_rss
+
+def run_scenario(name, count, threads=1, processes=1):
+    # the forked processes share the app and the database file, post_fork opens
+    # new database connections. A forked process starts with the peak memory usage
+    # equal to the current usage of the parent (on Linux).
+    from mqeapi import apiapp
+    pool = multiprocessing.Pool(processes, initializer=apiapp.post_fork)
+    try:
+        results = pool.map(_run_requests, [(name, count // processes, threads)] * processes)
+    finally:
+        pool.close()
+        pool.join()
+
+    latencies = [l for res in results for l in res[0]]
+    return OrderedDict([
+        ('scenario', name),
+        ('requests', len(latencies)),
+        ('errors', sum(res[1] for res in results)),
+        ('requestsPerSecond', round(len(latencies) / max(res[2] for res in results), 1)),
+        ('p50Ms', round(percentile(latencies, 50) * 1000, 2) if latencies else None),
+        ('p99Ms', round(percentile(latencies, 99) * 1000, 2) if latencies else None),
+        ('maxRssKb', max(res[3] for res in results)),
+        ('rssGrowthKb', max(res[4] for res in results)),
+    ])
+
+
+def create_bench(db_dir):
+    """Create the app using a SQLite3 database in ``db_dir`` and a user with an API key"""
+    from mqe import mqeconfig
+    mqeconfig.DATABASE_TYPE = 'sqlite3'
+    mqeconfig.SQLITE3_DATABASE = os.path.join(db_dir, 'mqe.db')
+
+    from mqeapi import apiconfig
+    apiconfig.LOGGING_LEVEL = None
+    apiconfig.DELETE_CHUNK_PAUSE = 0
+    apiconfig.JOB_STORE_DIR = os.path.join(db_dir, 'jobs')
+
+    from mqeapi import apiapp
+    app = apiapp.create()
+
+    from mqeweb import users
+    user = users.User.insert('bench@example.com', 'bench')
+    users.assign_new_api_key(user.user_id)
+    return Bench(app, users.select_api_key(user.user_id))
+
+
+def main():
+    global _bench
+
+    parser = argparse.ArgumentParser(description='Benchmark of the API endpoints')
+    parser.add_argument('-n', '--requests', type=int, default=200, help='the number of requests per scenario')
+    parser.add_argument('--threads', type=int, default=1, help='the number of threads sending requests')
+    parser.add_argument('--processes', type=int, default=1, help='the number of processes sending requests')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS.keys(),
+                        help='the scenario to run (can be repeated, by default all are run)')
+    parser.add_argument('--json', metavar='FILE', help='write the results as JSON to the file (- for stdout)')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='mqeapi-bench-')
+    try:
+        _bench = create_bench(db_dir)
+        _bench.prepare()
+
+        results = []
+        if args.json != '-':
+            sys.stdout.write('%-20s %9s %7s %10s %9s %9s %13s %16s\n' % (
+                'scenario', 'requests', 'errors', 'req/s', 'p50 [ms]', 'p99 [ms]', 'max RSS [kB]',
+                'RSS growth [kB]'))
+        for name in args.scenario or SCENARIOS.keys():
+            res = run_scenario(name, args.requests, args.threads, args.processes)
+            results.append(res)
+            if args.json != '-':
+                sys.stdout.write('%-20s %9s %7s %10s %9s %9s %13s %16s\n' % tuple(res.values()))
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    if args.json:
+        doc = OrderedDict([
+            ('timestamp', datetime.datetime.utcnow().isoformat()),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('requestsPerScenario', args.requests),
+            ('threads', args.threads),
+            ('processes', args.processes),
+            ('results', results),
+        ])
+        data = json.dumps(doc, indent=2)
+        if args.json == '-':
+            print data
+        else:
+            with open(args.json, 'w') as f:
+                f.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""A micro-benchmark of serializing API responses, comparing :meth:`ApiResponse.serialize`
+with serializing the :meth:`ApiResponse.envelope`. Run with::
+
+    $ python -m mqeapi.bench_responses
+"""
+
+import sys
+import timeit
+import uuid
+from collections import OrderedDict
+
+from mqe import serialize
+
+from mqeapi.responses import ApiResponse, envelope_fragments
+
+
+def small_response():
+    return ApiResponse(200, result=OrderedDict([('name', 'diskfree'),
+                                                ('href', 'http://localhost:8101/reports/diskfree')]))
+
+def error_response():
+    return ApiResponse(404, message='Report instance with id <%s> not found' % uuid.UUID(int=1).hex)
+
+def listing_result(instances=100, rows=50):
+    res = []
+    for i in range(instances):
+        desc = OrderedDict()
+        desc['id'] = uuid.uuid1().hex
+        desc['tags'] = ['ip:127.0.0.1']
+        desc['created'] = '2017-09-09T10:25:02.242814'
+        desc['rows'] = [['/dev/sda%s' % j, 1024 * j, 0.5, None, u'\u2603'] for j in range(rows)]
+        desc['header'] = [0]
+        desc['href'] = 'http://localhost:8101/reports/diskfree/instances/%s' % desc['id']
+        res.append(desc)
+    return res
+
+LISTING_RESULT = listing_result()
+
+def listing_response():
+    r = ApiResponse(200, result=LISTING_RESULT)
+    r.set_detail('next', None)
+    return r
+
+CASES = [
+    ('small', small_response, 20000),
+    ('error', error_response, 20000),
+    ('large_listing', listing_response, 20),
+]
+
+
+def envelope_serialize(r):
+    return serialize.json_dumps_external(r.envelope())
+
+def fast_serialize(r):
+    return r.serialize()
+
+
+def run(out=sys.stdout):
+    out.write('pre-encoded fragments used: %s\n' % (envelope_fragments() is not None))
+    out.write('%-15s %15s %15s %8s\n' % ('case', 'envelope [us]', 'serialize [us]', 'speedup'))
+    for name, create, number in CASES:
+        assert envelope_serialize(create()) == fast_serialize(create()), name
+        # each timed call serializes a new response, like a request does
+        t_envelope = min(timeit.repeat(lambda: envelope_serialize(create()), number=number, repeat=3))
+        t_fast = min(timeit.repeat(lambda: fast_serialize(create()), number=number, repeat=3))
+        out.write('%-15s %15.2f %15.2f %7.2fx\n' % (name, t_envelope / number * 1e6,
+                                                    t_fast / number * 1e6, t_envelope / t_fast))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,149 @@
+import itertools
+import zlib
+
+from flask import request
+
+from mqeapi import apiconfig
+from mqeapi import responses
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def _is_zlib_header(head):
+    return len(head) >= 2 and ord(head[0]) & 0x0f == zlib.DEFLATED \
+        and (ord(head[0]) << 8 | ord(head[1])) % 31 == 0
+
+def _decompressobj(content_encoding, head):
+    if content_encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # deflate is specified as a zlib-wrapped stream, but some clients send a raw stream,
+    # which is recognized by a missing zlib header (gzip streams are accepted too)
+    if _is_zlib_header(head) or head.startswith('\x1f\x8b'):
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+def request_content_encoding():
+    """Return the Content-Encoding of the request body, ``None`` for an uncompressed body.
+    An unsupported encoding raises :class:`ExceptionalResponse`."""
+    encoding = (request.headers.get('Content-Encoding') or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding not in ('gzip', 'deflate'):
+        raise responses.ExceptionalResponse(responses.ApiResponse(415,
+            message='Unsupported Content-Encoding <%s>, must be one of: <gzip>, <deflate>' % encoding))
+    return encoding
+
+def _too_large():
+    return responses.ExceptionalResponse(responses.ApiResponse(413,
+        message='Decompressed request body too large, maximum is %s bytes' % apiconfig.MAX_DECOMPRESSED_SIZE))
+
+def _corrupted():
+    return responses.ExceptionalResponse.bad_request('Invalid compressed request body')
+
+def iter_decompressed(chunks, content_encoding):
+    """Decompress the iterable of compressed chunks, raising :class:`ExceptionalResponse`
+    when the total decompressed size exceeds ``MAX_DECOMPRESSED_SIZE``"""
+    chunks = iter(chunks)
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 2:
+            break
+    chunks = itertools.chain([head], chunks)
+    d = _decompressobj(content_encoding, head)
+    size = 0
+    try:
+        for chunk in chunks:
+            while chunk:
+                out = d.decompress(chunk, READ_CHUNK_SIZE)
+                chunk = d.unconsumed_tail
+                size += len(out)
+                if size > apiconfig.MAX_DECOMPRESSED_SIZE:
+                    raise _too_large()
+                if out:
+                    yield out
+        out = d.flush()
+    except zlib.error:
+        raise _corrupted()
+    size += len(out)
+    if size > apiconfig.MAX_DECOMPRESSED_SIZE:
+        raise _too_large()
+    if out:
+        yield out
+
+def request_data():
+    """Return the request body, decompressed according to the Content-Encoding header"""
+    encoding = request_content_encoding()
+    if encoding is None:
+        return request.get_data()
+    return ''.join(iter_decompressed([request.get_data()], encoding))
+
+def _iter_stream_chunks(stream):
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def request_lines():
+    """Yield the lines of the request body, decompressed according to the Content-Encoding
+    header, without reading the whole body into the memory"""
+    encoding = request_content_encoding()
+    if encoding is None:
+        for line in request.stream:
+            yield line
+        return
+
+    pending = ''
+    for data in iter_decompressed(_iter_stream_chunks(request.stream), encoding):
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def _gzip_iter(chunks, sync_flush=False):
+    co = zlib.compressobj(apiconfig.COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = co.compress(chunk)
+        if sync_flush and chunk:
+            # the compressor would otherwise hold small chunks until more data arrives
+            out += co.flush(zlib.Z_SYNC_FLUSH)
+        if out:
+            yield out
+    yield co.flush()
+
+def compress_response(response):
+    """Compress the response using gzip when the client accepts it. Streamed responses
+    are compressed incrementally, flushing the compressed data after each chunk, so that
+    the client receives the chunks (like the statuses of ingested lines) without a delay.
+    Other responses are compressed only if they have at least ``COMPRESS_MIN_SIZE`` bytes.
+    Event streams aren't compressed, because compressing would delay the events."""
+    if not apiconfig.COMPRESS_RESPONSES:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.mimetype == 'text/event-stream':
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+
+    if response.is_streamed:
+        response.response = _gzip_iter(response.iter_encoded(), sync_flush=True)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < apiconfig.COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(''.join(_gzip_iter([data])))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    # the compressed representation has different bytes, so a strong ETag becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,63 @@
+"""Support for running the app by a cooperative (gevent) server, where a worker process
+handles many requests in greenlets. Database calls, which block in the drivers without
+yielding to the event loop, are dispatched by :func:`offload` to a bounded pool of OS
+threads, so that a slow call doesn't stop the other greenlets. Parsing inputs is dispatched
+too, but it's Python code holding the GIL, so it isn't executed in parallel with the greenlets.
+
+The mode is enabled by setting ``COOPERATIVE_MODE = True`` and running a gevent server
+(like ``gunicorn -k gevent``), which monkey-patches the standard library."""
+
+import logging
+import os
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+
+
+log = logging.getLogger('mqeapi.cooperative')
+
+
+_pool = None
+_pool_pid = None
+
+
+def enabled():
+    return apiconfig.COOPERATIVE_MODE
+
+def setup():
+    """Create the thread pool of the current process. Called after forking a worker."""
+    global _pool, _pool_pid
+    if not enabled():
+        return
+    from gevent import monkey
+    from gevent.threadpool import ThreadPool
+    if not monkey.is_module_patched('threading'):
+        log.warn('COOPERATIVE_MODE is set, but the threading module is not monkey-patched by gevent')
+    _pool = ThreadPool(apiconfig.COOPERATIVE_DAO_THREADS)
+    _pool_pid = os.getpid()
+
+def offload(fun, *args, **kwargs):
+    """Return ``fun(*args, **kwargs)``. In the cooperative mode, the call is executed by
+    a thread of the pool, while the calling greenlet waits without blocking other
+    greenlets. When all threads of the pool are busy, the call waits for a free thread."""
+    if not enabled():
+        return fun(*args, **kwargs)
+    if _pool is None or _pool_pid != os.getpid():
+        setup()
+    return _pool.apply(fun, args, kwargs)
+
+def map_greenlets(fun, items, size):
+    """Return ``[fun(item) for item in items]``, executing the calls by at most ``size``
+    greenlets"""
+    from gevent.pool import Pool
+    return Pool(size).map(fun, items)
+
+class _PoolStats(object):
+
+    def stats(self):
+        if _pool is None:
+            return {}
+        return {'depth': len(_pool), 'workers': _pool.size}
+
+
+metrics.queues.register('dao', _PoolStats())
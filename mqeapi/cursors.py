@@ -0,0 +1,95 @@
+"""Opaque cursors for paging through listings. A cursor is a URL-safe token holding the
+state of a listing query (like the position of the last returned item), signed with
+HMAC so that a client can't change the state of a cursor issued for another client."""
+
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import Queue
+
+from mqeapi import apiconfig
+from mqeapi import apicache
+from mqeapi import metrics
+from mqeapi.ingestqueue import IngestQueue
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip('=')
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+def _signature(payload, key):
+    # the key is specific to a client (an API key), so a cursor can't be used by other clients
+    secret = (apiconfig.CURSOR_SECRET or '') + key
+    if isinstance(secret, unicode):
+        secret = secret.encode('utf-8')
+    return _b64encode(hmac.new(secret, payload, hashlib.sha256).digest()[:18])
+
+def encode(state, key):
+    """Encode the ``state`` (a JSON-serializable dict) as a cursor signed with the ``key``"""
+    payload = _b64encode(json.dumps(state, separators=(',', ':')))
+    return '%s.%s' % (payload, _signature(payload, key))
+
+def decode(cursor, key):
+    """Return the state encoded in the cursor, or ``None`` if the cursor is invalid"""
+    try:
+        payload, signature = cursor.encode('ascii').split('.')
+    except (UnicodeError, ValueError):
+        return None
+    if not hmac.compare_digest(signature, _signature(payload, key)):
+        return None
+    try:
+        state = json.loads(_b64decode(payload))
+    except (TypeError, ValueError):
+        return None
+    return state if isinstance(state, dict) else None
+
+
+def dt_to_micros(dt):
+    if dt is None:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def micros_to_dt(micros):
+    if micros is None:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def prefetch(key, fun, *args, **kwargs):
+    """Execute ``fun(*args, **kwargs)`` in a background thread and keep the result for
+    ``CURSOR_PREFETCH_TTL`` seconds, to be taken by :func:`take_prefetched`. When too many
+    calls are waiting, the call is skipped."""
+    try:
+        prefetch_queue.submit(_prefetch, key, fun, args, kwargs)
+    except Queue.Full:
+        pass
+
+def _prefetch(key, fun, args, kwargs):
+    prefetched.put(key, fun(*args, **kwargs))
+
+def take_prefetched(key):
+    """Return the result of the :func:`prefetch` call with the ``key`` (removing it),
+    or ``None``"""
+    value = prefetched.get(key)
+    if value is not None:
+        prefetched.invalidate(key)
+    return value
+
+
+prefetch_queue = IngestQueue(apiconfig.CURSOR_PREFETCH_QUEUE_SIZE, apiconfig.CURSOR_PREFETCH_WORKERS,
+                             name='prefetch')
+
+prefetched = apicache.LRUCache(apiconfig.CURSOR_PREFETCH_CACHE_SIZE, apiconfig.CURSOR_PREFETCH_TTL)
+
+metrics.queues.register('prefetch', prefetch_queue)
+metrics.caches.register('prefetch', prefetched)
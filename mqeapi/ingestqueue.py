@@ -0,0 +1,109 @@
+import atexit
+import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+
+
+log = logging.getLogger('mqeapi.ingestqueue')
+
+
+class IngestQueue(object):
+    """A bounded in-process queue of tasks executed by a pool of worker threads. The threads
+    are started on the first submission, so that a process forked after creating the queue
+    starts its own workers.
+
+    :param int max_size: the maximal number of waiting tasks
+    :param int worker_count: the number of worker threads
+    :param str name: the name used for naming the threads
+    """
+
+    def __init__(self, max_size, worker_count, name='ingest'):
+        self.queue = Queue.Queue(max_size)
+        self.name = name
+        self.worker_count = max(1, worker_count)
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = None
+        self.max_lag = 0.0
+        self._workers = []
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def submit(self, fun, *args, **kwargs):
+        """Enqueue a call of ``fun`` with the passed arguments. Raises :class:`Queue.Full`
+        when the queue is full or is shutting down."""
+        if self._stopping:
+            raise Queue.Full()
+        self._ensure_workers()
+        self.queue.put_nowait((time.time(), fun, args, kwargs))
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._workers = [t for t in self._workers if t.is_alive()]
+            while len(self._workers) < self.worker_count:
+                t = threading.Thread(target=self._work, name='mqeapi-%s-%s' % (self.name, len(self._workers)))
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                enqueued, fun, args, kwargs = task
+                self.last_lag = time.time() - enqueued
+                self.max_lag = max(self.max_lag, self.last_lag)
+                try:
+                    fun(*args, **kwargs)
+                except Exception:
+                    self.failed += 1
+                    log.exception('Error when executing a queued task')
+                self.processed += 1
+            finally:
+                self.queue.task_done()
+
+    def shutdown(self, timeout=None):
+        """Stop accepting new tasks and wait at most ``timeout`` seconds until the already
+        enqueued tasks are executed"""
+        self._stopping = True
+        workers = [t for t in self._workers if t.is_alive()]
+        if not workers:
+            return
+        if timeout is None:
+            timeout = apiconfig.ASYNC_INGEST_DRAIN_TIMEOUT
+        log.info('Draining %s queue, %s tasks waiting', self.name, self.queue.qsize())
+        deadline = time.time() + timeout
+        for _ in workers:
+            try:
+                self.queue.put(None, timeout=max(0, deadline - time.time()))
+            except Queue.Full:
+                break
+        for t in workers:
+            t.join(max(0, deadline - time.time()))
+        if self.queue.qsize():
+            log.warn('The %s queue not drained, %s tasks lost', self.name, self.queue.qsize())
+
+    def stats(self):
+        return OrderedDict([
+            ('depth', self.queue.qsize()),
+            ('maxSize', self.queue.maxsize),
+            ('workers', len([t for t in self._workers if t.is_alive()])),
+            ('processed', self.processed),
+            ('failed', self.failed),
+            ('lastLag', self.last_lag),
+            ('maxLag', self.max_lag),
+        ])
+
+
+ingest_queue = IngestQueue(apiconfig.ASYNC_INGEST_QUEUE_SIZE, apiconfig.ASYNC_INGEST_WORKERS)
+
+metrics.queues.register('ingest', ingest_queue)
+
+atexit.register(ingest_queue.shutdown)
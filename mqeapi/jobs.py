@@ -0,0 +1,364 @@
+"""Background jobs executing long-running operations (like deleting many report
+instances) outside of request handling. The state of jobs is kept in a store shared by
+the processes of the server, so that any process can describe a job, and a job
+interrupted by an exit of its process is resumed by another process."""
+
+import atexit
+import datetime
+import errno
+import fcntl
+import hashlib
+import importlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+import Queue
+from collections import OrderedDict
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+from mqeapi.ingestqueue import IngestQueue
+
+
+log = logging.getLogger('mqeapi.jobs')
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+class FileStore(object):
+    """A store of JSON values kept in files of a directory, shared by the processes of
+    a host. A process claiming a key holds an exclusive lock (``flock``) of the key's lock
+    file - the lock is released by the system when the process exits, so a job claimed by
+    an exited process can be claimed by another process. Values not modified for ``ttl``
+    seconds are removed, unless ``keep(key, value)`` returns ``True``.
+
+    A custom store (for example using a database shared by multiple hosts) must implement
+    the same constructor signature and the methods :meth:`get`, :meth:`put`, :meth:`delete`,
+    :meth:`claim`, :meth:`release`, :meth:`keys` and :meth:`after_fork`.
+    """
+
+    PRUNE_INTERVAL = 600
+
+    def __init__(self, ttl, directory=None, keep=None):
+        self.ttl = ttl
+        self.keep = keep
+        self.directory = directory or apiconfig.JOB_STORE_DIR or \
+            os.path.join(tempfile.gettempdir(), 'mqeapi-jobs')
+        self._claimed = {}
+        self._lock = threading.Lock()
+        self._last_prune = 0
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key, suffix='.json'):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f, object_pairs_hook=OrderedDict)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def put(self, key, value):
+        # the renaming replaces the file atomically, readers never see a partial value
+        tmp_path = self._path(key, '.tmp-%s-%s' % (os.getpid(), threading.current_thread().ident))
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp_path, self._path(key))
+        self._prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def claim(self, key):
+        """Lock the key for the current process. Returns ``False`` if the key is already
+        claimed (by any process, including the current one)."""
+        with self._lock:
+            if key in self._claimed:
+                return False
+            f = open(self._path(key, '.lock'), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            self._claimed[key] = f
+            return True
+
+    def release(self, key):
+        with self._lock:
+            f = self._claimed.pop(key, None)
+        if f is not None:
+            f.close()
+
+    def keys(self, prefix=''):
+        return [name[:-len('.json')] for name in os.listdir(self.directory)
+                if name.startswith(prefix) and name.endswith('.json')]
+
+    def after_fork(self):
+        # the locks are held by the parent process, which executes the claimed jobs
+        with self._lock:
+            for f in self._claimed.values():
+                f.close()
+            self._claimed.clear()
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.lock') or now - os.path.getmtime(path) < self.ttl:
+                    continue
+                key = name.split('.', 1)[0]
+                if name.endswith('.json') and self.keep is not None and self.keep(key, self.get(key)):
+                    continue
+                os.remove(path)
+                if name.endswith('.json') and self.claim(key):
+                    # nobody holds the lock of the removed key
+                    os.remove(self._path(key, '.lock'))
+                    self.release(key)
+            except OSError:
+                pass
+
+
+class Job(object):
+    """A job of an owner, executing the function registered for the job's ``kind``
+    with the job's ``params`` (a JSON-serializable dict) as keyword arguments. The function
+    updates ``progress`` (a dict included in the job's description), calls :meth:`save`
+    to make the progress visible to other processes and :meth:`check_interrupted` between
+    steps of work. A job can be executed multiple times (when resumed), so the steps
+    must be repeatable."""
+
+    def __init__(self, owner_id, kind, report_name, params=None):
+        self.job_id = uuid.uuid4()
+        self.owner_id = owner_id
+        self.kind = kind
+        self.report_name = report_name
+        self.params = params or {}
+        self.status = 'pending'
+        self.progress = OrderedDict()
+        self.error = None
+        self.created = datetime.datetime.utcnow()
+        self.started = None
+        self.finished = None
+
+    @property
+    def key(self):
+        return 'job-%s' % self.job_id.hex
+
+    def check_interrupted(self):
+        if _stopping.is_set():
+            raise JobInterrupted()
+
+    def save(self):
+        store.put(self.key, self.state())
+
+    def state(self):
+        d = self.desc()
+        d['ownerId'] = self.owner_id.hex
+        d['params'] = self.params
+        return d
+
+    @classmethod
+    def from_state(cls, d):
+        job = cls(uuid.UUID(d['ownerId']), d['kind'], d['reportName'], d['params'])
+        job.job_id = uuid.UUID(d['id'])
+        job.status = d['status']
+        job.progress = d['progress']
+        job.error = d['error']
+        job.created = _parse_isoformat(d['created'])
+        job.started = _parse_isoformat(d['started'])
+        job.finished = _parse_isoformat(d['finished'])
+        return job
+
+    def desc(self):
+        return OrderedDict([
+            ('id', self.job_id.hex),
+            ('kind', self.kind),
+            ('reportName', self.report_name),
+            ('status', self.status),
+            ('progress', self.progress),
+            ('error', self.error),
+            ('created', _isoformat(self.created)),
+            ('started', _isoformat(self.started)),
+            ('finished', _isoformat(self.finished)),
+        ])
+
+
+def _isoformat(dt):
+    return dt.isoformat() if dt is not None else None
+
+def _parse_isoformat(s):
+    if s is None:
+        return None
+    return datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else '%Y-%m-%dT%H:%M:%S')
+
+
+_kinds = {}
+
+def register(kind, fun):
+    """Register the function executing jobs of the ``kind``"""
+    _kinds[kind] = fun
+
+def submit(job):
+    """Save the job and enqueue its execution. Raises :class:`Queue.Full` when too many
+    jobs are waiting."""
+    store.claim(job.key)
+    job.save()
+    try:
+        job_queue.submit(_run, job)
+    except Queue.Full:
+        store.delete(job.key)
+        store.release(job.key)
+        raise
+
+def get_job(owner_id, job_id):
+    """Return the job with the given id created by the owner, or ``None``. An unfinished
+    job of an exited process is resumed."""
+    state = store.get('job-%s' % job_id.hex)
+    if state is None or state['ownerId'] != owner_id.hex:
+        return None
+    job = Job.from_state(state)
+    if job.status in ('pending', 'running'):
+        resume(job.job_id)
+    return job
+
+def resume(job_id):
+    """Execute the unfinished job in the current process, unless it's claimed by
+    a process. Returns ``True`` if the job was resumed."""
+    key = 'job-%s' % job_id.hex
+    if not store.claim(key):
+        return False
+    # the job could finish before claiming it
+    state = store.get(key)
+    if state is None or state['status'] not in ('pending', 'running') or state['kind'] not in _kinds:
+        store.release(key)
+        return False
+    job = Job.from_state(state)
+    job.status = 'pending'
+    job.save()
+    try:
+        job_queue.submit(_run, job)
+    except Queue.Full:
+        store.release(key)
+        return False
+    log.info('Resuming job %s', job_id.hex)
+    return True
+
+def resume_interrupted():
+    """Resume the unfinished jobs which aren't claimed by any process"""
+    for key in store.keys('job-'):
+        state = store.get(key)
+        if state is not None and state['status'] in ('pending', 'running'):
+            resume(uuid.UUID(state['id']))
+
+def after_fork():
+    """Initialize the jobs of a forked process and resume interrupted jobs"""
+    store.after_fork()
+    resume_interrupted()
+
+def _run(job):
+    try:
+        job.check_interrupted()
+        job.status = 'running'
+        job.started = job.started or datetime.datetime.utcnow()
+        job.save()
+        _kinds[job.kind](job, **job.params)
+    except JobInterrupted:
+        job.status = 'pending'
+        log.warn('Job %s interrupted because of shutdown, it will be resumed by another process',
+                 job.job_id.hex)
+    except Exception:
+        job.status = 'failed'
+        job.error = 'Internal error'
+        log.exception('Error when executing job %s', job.job_id.hex)
+    else:
+        job.status = 'done'
+    if job.status != 'pending':
+        job.finished = datetime.datetime.utcnow()
+    job.save()
+    store.release(job.key)
+
+
+def _report_key(owner_id, report_name):
+    return 'report-%s' % hashlib.sha1((u'%s:%s' % (owner_id.hex, report_name)).encode('utf-8')).hexdigest()
+
+# (the keys of the hidden reports, the expiration time), cached to avoid reading
+# the store on each report lookup
+_hidden_reports = (frozenset(), 0)
+
+def _hidden_report_keys():
+    global _hidden_reports
+    keys, expires = _hidden_reports
+    now = time.time()
+    if now >= expires:
+        keys = frozenset(store.keys('report-'))
+        _hidden_reports = (keys, now + apiconfig.JOB_HIDDEN_REPORTS_TTL)
+    return keys
+
+def hide_report(owner_id, report_name, job):
+    """Mark the report as being deleted by the job, until :func:`unhide_report` is called"""
+    global _hidden_reports
+    store.put(_report_key(owner_id, report_name), {'jobId': job.job_id.hex})
+    _hidden_reports = (frozenset(), 0)
+
+def unhide_report(owner_id, report_name):
+    global _hidden_reports
+    store.delete(_report_key(owner_id, report_name))
+    _hidden_reports = (frozenset(), 0)
+
+def hiding_job_id(owner_id, report_name):
+    """Return the id of the job deleting the report, or ``None``. The reports hidden
+    by other processes are seen with a delay of up to ``JOB_HIDDEN_REPORTS_TTL`` seconds."""
+    key = _report_key(owner_id, report_name)
+    if key not in _hidden_report_keys():
+        return None
+    d = store.get(key)
+    return uuid.UUID(d['jobId']) if d else None
+
+
+def _shutdown():
+    _stopping.set()
+    job_queue.shutdown(apiconfig.JOB_DRAIN_TIMEOUT)
+
+
+def _unfinished(key, value):
+    # unfinished jobs and the markers of reports they hide aren't removed from the store
+    if value is not None and key.startswith('report-'):
+        value = store.get('job-%s' % value['jobId'])
+    return value is not None and value.get('status') in ('pending', 'running')
+
+def _create_store():
+    module_name, class_name = apiconfig.JOB_STORE.rsplit('.', 1)
+    store_class = getattr(importlib.import_module(module_name), class_name)
+    return store_class(apiconfig.JOB_TTL, keep=_unfinished)
+
+
+_stopping = threading.Event()
+
+job_queue = IngestQueue(apiconfig.JOB_QUEUE_SIZE, apiconfig.JOB_WORKERS, name='job')
+
+store = _create_store()
+
+metrics.queues.register('job', job_queue)
+
+atexit.register(_shutdown)
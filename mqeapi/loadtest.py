@@ -0,0 +1,127 @@
+"""A load test of a running server, comparing serving modes. Idle clients keep
+long-polling watch requests open, while active clients measure the throughput and
+the latency of regular requests. A sync server with N threads per worker can handle at
+most N connections at once, so the idle clients starve the active ones, while in the
+cooperative mode (``COOPERATIVE_MODE = True``, ``gunicorn -k gevent``) they don't.
+
+Example::
+
+    $ gunicorn -w 2 --threads 8 -b 0.0.0.0:8101 'mqeapi.apiapp:create()'
+    $ python -m mqeapi.loadtest --url http://localhost:8101 --key <API_KEY> --idle 100
+
+    $ gunicorn -w 2 -k gevent --worker-connections 2000 -b 0.0.0.0:8101 'mqeapi.apiapp:create()'
+    $ python -m mqeapi.loadtest --url http://localhost:8101 --key <API_KEY> --idle 100
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+
+REPORT_NAME = 'loadtest'
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class LoadTest(object):
+
+    def __init__(self, url, key, idle, concurrency, duration, path):
+        self.url = url.rstrip('/')
+        self.key = key
+        self.idle = idle
+        self.concurrency = concurrency
+        self.duration = duration
+        self.path = path
+        self.latencies = []
+        self.errors = 0
+        self.idle_requests = 0
+        self._lock = threading.Lock()
+        self._deadline = None
+
+    def _session(self):
+        session = requests.Session()
+        session.auth = (self.key, '')
+        return session
+
+    def _idle_client(self):
+        session = self._session()
+        while time.time() < self._deadline:
+            try:
+                session.get('%s/reports/%s/instances/watch' % (self.url, REPORT_NAME),
+                            params={'timeout': 60, 'fields': 'id'}, timeout=120)
+                with self._lock:
+                    self.idle_requests += 1
+            except requests.RequestException:
+                time.sleep(0.1)
+
+    def _active_client(self):
+        session = self._session()
+        while time.time() < self._deadline:
+            start = time.time()
+            try:
+                r = session.get(self.url + self.path, timeout=60)
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with self._lock:
+                if ok:
+                    self.latencies.append(time.time() - start)
+                else:
+                    self.errors += 1
+
+    def run(self):
+        r = self._session().post('%s/reports/%s' % (self.url, REPORT_NAME), data='1')
+        r.raise_for_status()
+
+        self._deadline = time.time() + self.duration
+        threads = [threading.Thread(target=self._idle_client) for _ in range(self.idle)]
+        threads += [threading.Thread(target=self._active_client) for _ in range(self.concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        time.sleep(self.duration)
+
+        with self._lock:
+            latencies = self.latencies[:]
+            return OrderedDict([
+                ('idleClients', self.idle),
+                ('activeClients', self.concurrency),
+                ('duration', self.duration),
+                ('requests', len(latencies)),
+                ('errors', self.errors),
+                ('requestsPerSecond', round(len(latencies) / float(self.duration), 1)),
+                ('p50Ms', _ms(percentile(latencies, 50))),
+                ('p99Ms', _ms(percentile(latencies, 99))),
+            ])
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of a running Monique API server')
+    parser.add_argument('--url', required=True, help='the base URL of the API')
+    parser.add_argument('--key', required=True, help='an API key')
+    parser.add_argument('--idle', type=int, default=100, help='the number of clients keeping watch requests open')
+    parser.add_argument('--concurrency', type=int, default=10, help='the number of clients sending requests')
+    parser.add_argument('--duration', type=int, default=30, help='the duration of the test in seconds')
+    parser.add_argument('--path', default='/reports/%s/instances?limit=10' % REPORT_NAME,
+                        help='the path requested by the active clients')
+    args = parser.parse_args()
+
+    result = LoadTest(args.url, args.key, args.idle, args.concurrency, args.duration, args.path).run()
+    print json.dumps(result, indent=2)
+
+
+if __name__ == '__main__':
+    main()
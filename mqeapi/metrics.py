@@ -0,0 +1,184 @@
+"""Process-local metrics rendered in the Prometheus text format. Each worker process of
+a multi-process server has its own metrics."""
+
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+
+def _escape(v):
+    return unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric(object):
+
+    type_name = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, '') for n in self.label_names)
+
+    def _header(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type_name)]
+
+
+class Counter(Metric):
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append('%s%s %s' % (self.name, _format_labels(zip(self.label_names, key)),
+                                          _format_value(value)))
+        return lines
+
+
+class Gauge(Counter):
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                label_pairs = zip(self.label_names, key)
+                cumulative = 0
+                for upper, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (self.name,
+                        _format_labels(label_pairs + [('le', _format_value(upper))]), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, _format_labels(label_pairs), _format_value(total)))
+                lines.append('%s_count%s %s' % (self.name, _format_labels(label_pairs), cumulative))
+        return lines
+
+
+class StatsCollector(object):
+    """Exports values returned by the ``stats()`` method of registered objects (like caches
+    and queues). ``mapping`` is a list of tuples (stats key, metric name, metric type, help)."""
+
+    def __init__(self, label_name, mapping):
+        self.label_name = label_name
+        self.mapping = mapping
+        self.sources = OrderedDict()
+        registry.append(self)
+
+    def register(self, name, obj):
+        self.sources[name] = obj
+
+    def render(self):
+        stats = [(name, obj.stats()) for name, obj in self.sources.items()]
+        lines = []
+        for stats_key, metric_name, type_name, help in self.mapping:
+            values = [(name, st[stats_key]) for name, st in stats if st.get(stats_key) is not None]
+            if not values:
+                continue
+            lines.append('# HELP %s %s' % (metric_name, help))
+            lines.append('# TYPE %s %s' % (metric_name, type_name))
+            for name, value in values:
+                lines.append('%s%s %s' % (metric_name, _format_labels([(self.label_name, name)]),
+                                          _format_value(value)))
+        return lines
+
+
+registry = []
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('mqeapi_requests_total', 'The number of handled requests',
+                   ('method', 'route', 'status'))
+REQUEST_DURATION = Histogram('mqeapi_request_duration_seconds',
+                             'The time of handling a request, until the response headers are ready',
+                             ('method', 'route', 'status'))
+REQUEST_SIZE = Histogram('mqeapi_request_size_bytes', 'The size of request bodies',
+                         ('method', 'route'), SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram('mqeapi_response_size_bytes', 'The size of non-streamed response bodies',
+                          ('method', 'route'), SIZE_BUCKETS)
+PHASE_DURATION = Histogram('mqeapi_phase_duration_seconds',
+                           'The time spent in a phase of handling requests', ('phase',))
+STARTUP_DURATION = Gauge('mqeapi_startup_duration_seconds',
+                         'The time spent in a step of starting the app', ('step',))
+
+caches = StatsCollector('cache', [
+    ('size', 'mqeapi_cache_entries', 'gauge', 'The number of cached entries'),
+    ('bytes', 'mqeapi_cache_bytes', 'gauge', 'The size of cached data'),
+    ('hits', 'mqeapi_cache_hits_total', 'counter', 'The number of cache hits'),
+    ('misses', 'mqeapi_cache_misses_total', 'counter', 'The number of cache misses'),
+    ('invalidations', 'mqeapi_cache_invalidations_total', 'counter', 'The number of invalidated entries'),
+])
+
+queues = StatsCollector('queue', [
+    ('depth', 'mqeapi_queue_depth', 'gauge', 'The number of waiting tasks'),
+    ('processed', 'mqeapi_queue_processed_total', 'counter', 'The number of executed tasks'),
+    ('failed', 'mqeapi_queue_failed_total', 'counter', 'The number of failed tasks'),
+    ('dropped', 'mqeapi_queue_dropped_total', 'counter', 'The number of tasks dropped because of a full queue'),
+    ('lastLag', 'mqeapi_queue_lag_seconds', 'gauge', 'The waiting time of the last started task'),
+])
+
+
+@contextmanager
+def timed(phase):
+    """Measure the time of executing the block as a phase of handling requests"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        PHASE_DURATION.observe(time.time() - start, phase=phase)
@@ -0,0 +1,96 @@
+"""A hub notifying requests waiting for new report instances. The hub is local to
+a process - only report instances created by the same process wake the waiting requests
+immediately, so waiting requests also check the database periodically.
+
+Waiting uses ``threading.Condition`` - when running under gevent with monkey-patched
+``threading``, a waiting request occupies a greenlet instead of a thread."""
+
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from mqeapi import metrics
+
+
+class _Topic(object):
+
+    __slots__ = ('cond', 'version', 'subscribers')
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.version = 0
+        self.subscribers = 0
+
+
+class Subscription(object):
+    """A subscription to notifications published for a key, returned by
+    :meth:`NotificationHub.subscribe`. The ``version`` of the subscription is increased
+    by each notification."""
+
+    def __init__(self, hub, topic):
+        self._hub = hub
+        self._topic = topic
+
+    @property
+    def version(self):
+        with self._hub._lock:
+            return self._topic.version
+
+    def wait(self, version, timeout):
+        """Wait at most ``timeout`` seconds until the ``version`` changes. Returns ``True``
+        when it changed."""
+        with self._hub._lock:
+            if self._topic.version == version:
+                self._topic.cond.wait(timeout)
+            return self._topic.version != version
+
+
+class NotificationHub(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = {}
+        self.published = 0
+
+    @contextmanager
+    def subscribe(self, key):
+        """A context manager returning a :class:`Subscription` to the ``key``. Notifications
+        published between reading the subscription's version and waiting aren't lost."""
+        with self._lock:
+            topic = self._topics.get(key)
+            if topic is None:
+                topic = self._topics[key] = _Topic(self._lock)
+            topic.subscribers += 1
+        try:
+            yield Subscription(self, topic)
+        finally:
+            with self._lock:
+                topic.subscribers -= 1
+                if not topic.subscribers:
+                    del self._topics[key]
+
+    def publish(self, key):
+        """Wake the requests subscribed to the ``key``"""
+        with self._lock:
+            self.published += 1
+            topic = self._topics.get(key)
+            if topic is None:
+                return
+            topic.version += 1
+            topic.cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([
+                ('topics', len(self._topics)),
+                ('subscribers', sum(t.subscribers for t in self._topics.values())),
+                ('published', self.published),
+            ])
+
+
+hub = NotificationHub()
+
+metrics.StatsCollector('hub', [
+    ('subscribers', 'mqeapi_watch_subscribers', 'gauge', 'The number of requests waiting for new report instances'),
+    ('published', 'mqeapi_watch_notifications_total', 'counter', 'The number of published notifications of new report instances'),
+]).register('instances', hub)
@@ -0,0 +1,140 @@
+import hashlib
+import importlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from mqeapi import apiconfig
+from mqeapi import metrics
+
+
+class LocalStore(object):
+    """An in-memory store of the response cache, local to a process. The entries are
+    evicted in the least-recently-used order when their total size exceeds ``max_bytes``.
+
+    A custom store (for example using a shared memory or an external server) must implement
+    the same constructor signature and the methods :meth:`get`, :meth:`set`, :meth:`delete`.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            value, size, expires = entry
+            if expires <= time.time():
+                self.size -= size
+                return None
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, size):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_bytes:
+                return
+            self._data[key] = (value, size, time.time() + self.ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.size -= evicted_size
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+
+class ResponseCache(object):
+    """A cache of serialized responses listing report instances, keyed by an owner, a report
+    name, an API key and query parameters. The entries of a report are invalidated by changing the report's
+    generation - a random value included in the keys of the entries, which is kept in the store
+    too, so that a store shared by processes is invalidated for all of them.
+
+    :param store: a store object (like :class:`LocalStore`) or ``None`` to disable the cache
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def _generation_key(self, owner_id, report_name):
+        return 'mqeapi:gen:%s' % hashlib.sha1(repr((owner_id, report_name))).hexdigest()
+
+    def _generation(self, owner_id, report_name):
+        gen_key = self._generation_key(owner_id, report_name)
+        gen = self.store.get(gen_key)
+        if gen is None:
+            gen = uuid.uuid4().hex
+            self.store.set(gen_key, gen, len(gen_key) + len(gen))
+        return gen
+
+    def key(self, owner_id, report_name, api_key, args):
+        """Compute the key of a response for the request's query ``args``. The ``api_key``
+        is a part of the key, because the cursors of the cached ``next`` links are valid only
+        with the API key of the request. The key must be computed before fetching the data
+        to cache, so that an invalidation happening in the meantime isn't lost."""
+        if not self.enabled:
+            return None
+        gen = self._generation(owner_id, report_name)
+        normalized_args = sorted((k, sorted(vs)) for k, vs in args.lists())
+        return 'mqeapi:resp:%s' % hashlib.sha1(repr((owner_id, report_name, api_key, gen,
+                                                     normalized_args))).hexdigest()
+
+    def get(self, key):
+        """Return a pair (data, headers) of a cached response or ``None``"""
+        if not self.enabled:
+            return None
+        res = self.store.get(key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def put(self, key, data, headers):
+        if not self.enabled:
+            return
+        self.store.set(key, (data, headers), len(data))
+
+    def invalidate(self, owner_id, report_name):
+        if not self.enabled:
+            return
+        self.store.delete(self._generation_key(owner_id, report_name))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return OrderedDict([
+            ('enabled', self.enabled),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('hitRatio', float(self.hits) / total if total else None),
+            ('bytes', getattr(self.store, 'size', None)),
+        ])
+
+
+def _create_store():
+    if not apiconfig.RESPONSE_CACHE_ENABLED:
+        return None
+    module_name, class_name = apiconfig.RESPONSE_CACHE_STORE.rsplit('.', 1)
+    store_class = getattr(importlib.import_module(module_name), class_name)
+    return store_class(apiconfig.RESPONSE_CACHE_MAX_BYTES, apiconfig.RESPONSE_CACHE_TTL)
+
+response_cache = ResponseCache(_create_store())
+metrics.caches.register('response', response_cache)
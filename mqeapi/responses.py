@@ -2,13 +2,15 @@ import logging
 from collections import OrderedDict
 import json
 
-from flask import request
+from flask import request, stream_with_context
 
 from werkzeug.wrappers import Response
 from werkzeug import http
 
 from mqe import serialize
 
+from mqeapi import metrics
+
 
 log = logging.getLogger('mqeapi.responses')
 
@@ -23,10 +25,17 @@ def fallback_response():
     return Response(data, status=500, mimetype='application/json')
 
 
+def json_line(d):
+    """Serialize the object as a single line of newline-delimited JSON"""
+    # JSON strings never contain raw newlines, so removing them keeps the document valid
+    return serialize.json_dumps_external(d).replace('\n', '') + '\n'
+
+
 class ApiResponse(object):
 
-    def __init__(self, status=None, success=None, details=None, result=None, result_pairs=None, message=None, docs=None, error_code=None, details_pairs=None):
+    def __init__(self, status=None, success=None, details=None, result=None, result_pairs=None, message=None, docs=None, error_code=None, details_pairs=None, headers=None):
         self.status = status
+        self.headers = headers
         self.success = success
         self.details = details
         if details_pairs:
@@ -90,7 +99,14 @@ class ApiResponse(object):
         pos_keys = sorted(enumerate(self.details.keys()), key=sort_key)
         return OrderedDict([(pk[1], self.details[pk[1]]) for pk in pos_keys])
 
-    def _do_get(self):
+    def _output_details(self):
+        # skip copying when the details are already in the output order
+        ranks = [0 if k == 'message' else 1 if k == 'errorCode' else 2 for k in self.details]
+        if ranks == sorted(ranks):
+            return self.details
+        return self._sorted_details()
+
+    def _set_defaults(self):
         assert self.status in http.HTTP_STATUS_CODES
 
         if self.success is None:
@@ -98,14 +114,134 @@ class ApiResponse(object):
         if not self.success and (self.details is None or self.details.get('errorCode') is None):
             self.error_code = 'ERROR_%s' % (self.status if self.status != 200 else 'OTHER')
 
+    def envelope(self):
+        """Return the JSON object (as an ``OrderedDict``) forming the response body"""
+        self._set_defaults()
+
         d = OrderedDict()
         d['success'] = self.success
         if self.details is not None:
             d['details'] = self._sorted_details()
         if self.result is not None:
             d['result'] = self.result
-        data = serialize.json_dumps_external(d)
-        return Response(data, status=self.status, mimetype='application/json')
+        return d
+
+    def serialize(self):
+        """Return the serialized response body. The result is the same as serializing
+        :meth:`envelope`, but the constant parts of the envelope are pre-encoded
+        and the envelope and the details aren't copied."""
+        fragments = envelope_fragments()
+        if fragments is None:
+            return serialize.json_dumps_external(self.envelope())
+        return self._serialize_fragments(fragments)
+
+    def _serialize_fragments(self, fragments):
+        self._set_defaults()
+        if self.success is True:
+            parts = [fragments.success_true]
+        elif self.success is False:
+            parts = [fragments.success_false]
+        else:
+            parts = [fragments.success, serialize.json_dumps_external(self.success)]
+        if self.details is not None:
+            parts.append(fragments.details)
+            parts.append(serialize.json_dumps_external(self._output_details()))
+        if self.result is not None:
+            parts.append(fragments.result)
+            parts.append(serialize.json_dumps_external(self.result))
+        parts.append(fragments.end)
+        return ''.join(parts)
+
+    def _do_get(self):
+        with metrics.timed('serialization'):
+            data = self.serialize()
+        return Response(data, status=self.status, headers=self.headers, mimetype='application/json')
+
+
+class EnvelopeFragments(object):
+    """Pre-encoded parts of a serialized response envelope, derived from the output of
+    ``serialize.json_dumps_external``. The fragments can be used only when the encoder
+    doesn't indent the output, so that a nested value is serialized the same way
+    as a top-level value."""
+
+    def __init__(self, key_sep, item_sep):
+        self.item_sep = item_sep
+        self.success = '{"success"' + key_sep
+        self.success_true = self.success + 'true'
+        self.success_false = self.success + 'false'
+        self.details = item_sep + '"details"' + key_sep
+        self.result = item_sep + '"result"' + key_sep
+        self.end = '}'
+
+    @staticmethod
+    def from_encoder():
+        """Return fragments matching the encoder or ``None`` if they can't be used"""
+        probe = serialize.json_dumps_external(OrderedDict([('a', 0), ('b', 0)]))
+        if not (probe.startswith('{"a"') and probe.endswith('0}')):
+            return None
+        key_sep, rest = probe[len('{"a"'):].split('0', 1)
+        item_sep = rest.split('"b"', 1)[0]
+        fragments = EnvelopeFragments(str(key_sep), str(item_sep))
+
+        # verify the fragments on a sample response
+        sample = ApiResponse(400, message=u'm\xe9', result=[None, 1.5, {'a': [u'\u2603']}])
+        sample.set_detail('next', None)
+        if sample._serialize_fragments(fragments) != serialize.json_dumps_external(sample.envelope()):
+            return None
+        return fragments
+
+# the fragments of the default json separators, used for streaming when the encoder's
+# fragments can't be used
+DEFAULT_FRAGMENTS = EnvelopeFragments(': ', ', ')
+
+_envelope_fragments = None
+_envelope_fragments_computed = False
+
+def envelope_fragments():
+    global _envelope_fragments, _envelope_fragments_computed
+    if not _envelope_fragments_computed:
+        _envelope_fragments = EnvelopeFragments.from_encoder()
+        if _envelope_fragments is None:
+            log.info('Pre-encoded envelope fragments don\'t match the json encoder, not using them')
+        _envelope_fragments_computed = True
+    return _envelope_fragments
+
+
+class StreamingApiResponse(ApiResponse):
+    """A successful response having a list as the result, which is serialized incrementally,
+    item by item, while the ``result_iter`` is consumed. Since the details can depend on the
+    streamed items, they are put after the result and can be set by ``details_callback``,
+    called with the response object as the argument after the iteration."""
+
+    def __init__(self, status, result_iter, details_callback=None, **kwargs):
+        super(StreamingApiResponse, self).__init__(status, **kwargs)
+        self.result_iter = result_iter
+        self.details_callback = details_callback
+
+    def _generate(self):
+        # the same separators as of serialized (non-streamed) responses
+        fragments = envelope_fragments() or DEFAULT_FRAGMENTS
+        try:
+            yield fragments.success + serialize.json_dumps_external(self.success) + fragments.result + '['
+            first = True
+            for item in self.result_iter:
+                yield ('' if first else fragments.item_sep) + serialize.json_dumps_external(item)
+                first = False
+            yield ']'
+            if self.details_callback:
+                self.details_callback(self)
+            if self.details is not None:
+                yield fragments.details + serialize.json_dumps_external(self._sorted_details())
+            yield fragments.end
+        except:
+            # the status was already sent, the client gets a truncated document
+            log.exception('Error when streaming json response')
+
+    def _do_get(self):
+        assert self.status in http.HTTP_STATUS_CODES
+        self.success = True
+        return Response(stream_with_context(self._generate()), status=self.status,
+                        headers=self.headers, mimetype='application/json')
 
 
 def not_found():
@@ -123,6 +259,15 @@ def unauthorized():
 def bad_request(message):
     return ApiResponse(400, message=message)
 
+def service_unavailable(message, retry_after):
+    return ApiResponse(503, message=message, headers={'Retry-After': str(retry_after)})
+
+def too_many_requests(message, retry_after):
+    return ApiResponse(429, message=message, headers={'Retry-After': str(retry_after)})
+
+def not_modified(headers):
+    return Response(status=304, headers=headers)
+
 def method_not_allowed():
     resp = ApiResponse(405, False)
     resp.message = """The method %s is not allowed for the resource '%s'""" % \
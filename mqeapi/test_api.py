@@ -3,17 +3,37 @@ import json
 import unittest
 
 import datetime
+import time
+import threading
+import tempfile
+import shutil
+import uuid
+import zlib
+import logging
 import requests
+from flask import Flask, Response
+from werkzeug.datastructures import MultiDict
 
 from mqeweb import users
 
-from mqeapi import apiconfig, apiutil
+from mqeapi import apiconfig, apiutil, apicache, responses, admission, responsecache, jobs, cursors, \
+    accesslog
+from mqe import serialize
+from mqe import reports
 
 
 from mqe.dao.daoregistry import register_dao_modules_from_config
 register_dao_modules_from_config(apiconfig)
 
 
+def metric_value(text, name):
+    """Return the value of the metric line starting with ``name`` (including the labels)"""
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[-1])
+    return 0.0
+
+
 class TestBase(unittest.TestCase):
 
     def setUp(self):
@@ -43,11 +63,79 @@ class ReportsTest(TestBase):
         self.assertEqual([0], r.json()['result']['header'])
         return r
 
+    def test_post_compressed(self):
+        d = [OrderedDict([('c1', i), ('c2', 'x' * 100)]) for i in range(100)]
+        co = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = co.compress(json.dumps(d)) + co.flush()
+        r = self.request('POST', '/reports/aaa', data=data, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(101, len(r.json()['result']['rows']))
+        self.assertEqual('gzip', r.headers.get('Content-Encoding'))
+
+        # deflate is accepted both zlib-wrapped and raw
+        for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+            co = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            data = co.compress(json.dumps(d)) + co.flush()
+            r = self.request('POST', '/reports/aaa', data=data, headers={'Content-Encoding': 'deflate'})
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(101, len(r.json()['result']['rows']))
+
+        r = self.request('POST', '/reports/aaa', data='1', headers={'Content-Encoding': 'br'})
+        self.assertEqual(415, r.status_code)
+
+    def test_post_changing_format(self):
+        r = self.request('POST', '/reports/fmt', data=json.dumps([{'c1': 1}, {'c1': 2}]))
+        self.assertEqual([['c1'], [1], [2]], r.json()['result']['rows'])
+        r = self.request('POST', '/reports/fmt', data=json.dumps([{'c1': 3}]))
+        self.assertEqual([['c1'], [3]], r.json()['result']['rows'])
+
+        r = self.request('POST', '/reports/fmt', data='c1,c2\n1,2\n')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(2, len(r.json()['result']['rows'][0]))
+
+    def test_input_type_memo(self):
+        report = reports.Report.select_or_insert(self.user.user_id, 'memo0')
+        ipres = report.process_input(json.dumps([{'c1': 1}]), input_type='any')
+        self.assertEqual('json', apiutil.detected_input_type(ipres))
+
+        if apiconfig.METRICS_ENABLED:
+            hits_metric = 'mqeapi_cache_hits_total{cache="inputType"}'
+            hits = metric_value(requests.get('%s/metrics' % apiconfig.BASE_URL_API).text, hits_metric)
+            self.request('POST', '/reports/memo', data=json.dumps([{'c1': 1}]))
+            self.request('POST', '/reports/memo', data=json.dumps([{'c1': 2}]))
+            self.assertGreater(metric_value(requests.get('%s/metrics' % apiconfig.BASE_URL_API).text,
+                                            hits_metric), hits)
+
+        # a catch-all type isn't remembered, so the next input's format is guessed
+        r = self.request('POST', '/reports/memo', data='monique has 123 points')
+        self.assertEqual(200, r.status_code)
+        r = self.request('POST', '/reports/memo', data=json.dumps([{'c1': 3}]))
+        self.assertEqual([['c1'], [3]], r.json()['result']['rows'])
+
     def test_get_single(self):
         r_post = self.test_post()
         r = self.request('GET', '/reports/aaa/instances/%s' % r_post.json()['result']['id'])
         self.assertEqual(r_post.json()['result']['rows'], r.json()['result']['rows'])
 
+    def test_get_conditional(self):
+        r_post = self.test_post()
+        path = '/reports/aaa/instances/%s' % r_post.json()['result']['id']
+        r = self.request('GET', path)
+        self.assertIn('max-age', r.headers['Cache-Control'])
+        r2 = self.request('GET', path, headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(304, r2.status_code)
+        self.assertEqual('', r2.text)
+
+        r = self.request('GET', '/reports/aaa/instances')
+        self.assertTrue(r.headers['ETag'].startswith('W/'))
+        r2 = self.request('GET', '/reports/aaa/instances', headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(304, r2.status_code)
+
+        self.test_post()
+        r3 = self.request('GET', '/reports/aaa/instances', headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(200, r3.status_code)
+        self.assertEqual(2, len(r3.json()['result']))
+
     def test_get_multi(self):
         self.test_post()
         r_post = self.test_post()
@@ -58,6 +146,150 @@ class ReportsTest(TestBase):
         self.assertEqual(r_post.json()['result']['rows'], r.json()['result'][1]['rows'])
         return r
 
+    def test_get_multi_stream(self):
+        for i in range(3):
+            self.test_post()
+
+        r = self.request('GET', '/reports/aaa/instances?limit=2')
+        r_stream = self.request('GET', '/reports/aaa/instances?limit=2&stream=1')
+        self.assertEqual(200, r_stream.status_code)
+        self.assertEqual(r.json()['result'], r_stream.json()['result'])
+        self.assertIsNotNone(r_stream.json()['details']['next'])
+
+        r_stream = self.request('GET', '/reports/aaa/instances?stream=1&limit=1000')
+        self.assertEqual(3, len(r_stream.json()['result']))
+        self.assertIsNone(r_stream.json()['details']['next'])
+
+    def test_get_multi_cursor(self):
+        ids = [self.test_post().json()['result']['id'] for i in range(3)]
+
+        r = self.request('GET', '/reports/aaa/instances', params={'limit': 2, 'order': 'desc',
+                                                                   'fields': 'id'})
+        self.assertEqual(ids[:0:-1], [ri['id'] for ri in r.json()['result']])
+        self.assertIn('cursor=', r.json()['details']['next'])
+
+        r = requests.get(r.json()['details']['next'])
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([{'id': ids[0]}], r.json()['result'])
+        self.assertIsNone(r.json()['details']['next'])
+
+        r = self.request('GET', '/reports/aaa/instances', params={'cursor': 'abc.def'})
+        self.assertEqual(400, r.status_code)
+
+    def test_get_multi_cursor_flags(self):
+        ids = [self.test_post().json()['result']['id'] for i in range(3)]
+
+        for params in [{'expand': '0'}, {'expand': 'true', 'expandInput': '1'}, {'stream': '1'}]:
+            params['limit'] = 2
+            r = self.request('GET', '/reports/aaa/instances', params=params)
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(ids[:2], [ri['id'] for ri in r.json()['result']])
+
+            r = requests.get(r.json()['details']['next'])
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(ids[2:], [ri['id'] for ri in r.json()['result']])
+            self.assertEqual('rows' in r.json()['result'][0], params.get('expand') != '0')
+
+    def test_get_multi_cursor_invalid_state(self):
+        self.test_post()
+        key = users.select_api_key(self.user.user_id)
+        for state in [{'k': 'instances', 'r': 'aaa', 'l': 1000000000},
+                      {'k': 'instances', 'r': 'aaa', 'l': 1, 'a': 'zz'},
+                      {'k': 'instances', 'r': 'aaa', 'l': '1'},
+                      {'k': 'instances', 'r': 'aaa', 'l': 1, 'g': [1]},
+                      {'k': 'instances', 'r': 'aaa'}]:
+            r = self.request('GET', '/reports/aaa/instances',
+                             params={'cursor': cursors.encode(state, key)})
+            self.assertEqual(400, r.status_code)
+
+        r = self.request('GET', '/reports', params={'cursor': cursors.encode({'k': 'reports', 'l': 1}, key)})
+        self.assertEqual(400, r.status_code)
+
+    def test_get_multi_ids(self):
+        ids = [self.test_post().json()['result']['id'] for i in range(2)]
+        missing = '0' * 32
+
+        r = self.request('GET', '/reports/aaa/instances',
+                         params={'ids': ','.join([ids[1], missing, ids[0], ids[1]])})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([ids[1], None, ids[0], ids[1]],
+                         [ri['id'] if ri else None for ri in r.json()['result']])
+        self.assertEqual([missing], r.json()['details']['notFound'])
+
+        r = self.request('POST', '/reports/aaa/instances', params={'fields': 'id'},
+                         data=json.dumps({'ids': ids}))
+        self.assertEqual([{'id': ids[0]}, {'id': ids[1]}], r.json()['result'])
+
+        r = self.request('GET', '/reports/aaa/instances', params={'ids': 'xyz'})
+        self.assertEqual(400, r.status_code)
+
+    def test_get_latest(self):
+        self.request('POST', '/reports/lat1', data='1')
+        r_post = self.request('POST', '/reports/lat1', data='2')
+        self.request('POST', '/reports/lat2', data='3')
+
+        r = self.request('GET', '/latest', params={'reports': 'lat1, nonexisting, lat2'})
+        self.assertEqual(200, r.status_code)
+        result = r.json()['result']
+        self.assertEqual(['lat1', 'nonexisting', 'lat2'], [res['name'] for res in result])
+        self.assertEqual(r_post.json()['result']['id'], result[0]['instance']['id'])
+        self.assertIsNone(result[1]['instance'])
+        self.assertEqual(['nonexisting'], r.json()['details']['notFound'])
+
+        r = self.request('GET', '/latest', params={'prefix': 'lat', 'fields': 'id'})
+        self.assertEqual(['lat1', 'lat2'], [res['name'] for res in r.json()['result']])
+
+    def test_watch(self):
+        r_post = self.test_post()
+        last_id = r_post.json()['result']['id']
+
+        r = self.request('GET', '/reports/aaa/instances/watch', params={'timeout': 0})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([], r.json()['result'])
+        self.assertEqual(last_id, r.json()['details']['lastId'])
+
+        def post_later():
+            time.sleep(0.5)
+            self.test_post()
+        t = threading.Thread(target=post_later)
+        t.start()
+        start = time.time()
+        r = self.request('GET', '/reports/aaa/instances/watch', params={'afterId': last_id, 'timeout': 10})
+        t.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(1, len(r.json()['result']))
+        self.assertNotEqual(last_id, r.json()['details']['lastId'])
+
+    def test_export(self):
+        r1 = self.test_post()
+        r2 = self.test_post()
+
+        r = self.request('GET', '/reports/aaa/export')
+        self.assertEqual(200, r.status_code)
+        exported = [json.loads(l) for l in r.text.splitlines()]
+        self.assertEqual([r1.json()['result']['id'], r2.json()['result']['id']],
+                         [d['id'] for d in exported])
+        self.assertEqual(r1.json()['result']['rows'], exported[0]['rows'])
+
+        r = self.request('GET', '/reports/aaa/export?format=csv')
+        lines = r.text.splitlines()
+        self.assertEqual('id,created,tags,cells', lines[0])
+        self.assertEqual(5, len(lines))
+        self.assertTrue(lines[1].startswith(r1.json()['result']['id']))
+
+    def test_get_multi_after_write(self):
+        self.test_post()
+        r = self.request('GET', '/reports/aaa/instances?order=desc')
+        self.assertEqual(1, len(r.json()['result']))
+
+        self.test_post()
+        r = self.request('GET', '/reports/aaa/instances?order=desc')
+        self.assertEqual(2, len(r.json()['result']))
+
+        self.request('DELETE', '/reports/aaa/instances/%s' % r.json()['result'][0]['id'])
+        r = self.request('GET', '/reports/aaa/instances?order=desc')
+        self.assertEqual(1, len(r.json()['result']))
+
     def test_delete_single(self):
         r_get = self.test_get_multi()
 
@@ -129,5 +361,406 @@ class ReportsTest(TestBase):
         r = self.request('GET', '/reports/aaa/instances')
         self.assertEqual(404, r.status_code)
 
+    def test_post_after_delete_report(self):
+        self.test_delete_report()
+
+        self.test_post()
+        r = self.request('GET', '/reports/aaa/instances')
+        self.assertEqual(1, len(r.json()['result']))
+
+    def test_post_batch(self):
+        items = [{'input': '1', 'tags': ['p1:v1']},
+                 {'input': [{'c1': 1}]},
+                 {'input': ''}]
+        r = self.request('POST', '/reports/ccc/batch', data='\n'.join(json.dumps(i) for i in items))
+        self.assertEqual(200, r.status_code)
+        results = r.json()['result']
+        self.assertEqual([True, True, False], [res['success'] for res in results])
+        self.assertEqual(['p1:v1'], results[0]['result']['tags'])
+        self.assertEqual('ERROR_EMPTY_REPORT_DATA', results[2]['details']['errorCode'])
+        self.assertEqual(2, r.json()['details']['created'])
+
+        r = self.request('POST', '/reports/ccc/batch', data=json.dumps(['3', '4']))
+        self.assertEqual([True, True], [res['success'] for res in r.json()['result']])
+
+        r = self.request('GET', '/reports/ccc/instances')
+        self.assertEqual(4, len(r.json()['result']))
+
+    def test_get_fields(self):
+        r_post = self.request('POST', '/reports/fff', data='1', params={'tags': 'p1:v1'})
+        id = r_post.json()['result']['id']
+
+        r = self.request('GET', '/reports/fff/instances', params={'fields': 'id,created'})
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({'id', 'created'}, set(r.json()['result'][0].keys()))
+
+        r = self.request('GET', '/reports/fff/instances/%s' % id, params={'fields': 'tags,rows'})
+        self.assertEqual(['p1:v1'], r.json()['result']['tags'])
+        self.assertEqual(r_post.json()['result']['rows'], r.json()['result']['rows'])
+        self.assertNotIn('input', r.json()['result'])
+
+        r = self.request('GET', '/reports/fff/instances', params={'fields': 'id,size'})
+        self.assertEqual(400, r.status_code)
+
+    def test_get_stats(self):
+        for created in ['2017-01-01T10:00:00', '2017-01-01T10:30:00', '2017-01-01T12:00:00']:
+            self.request('POST', '/reports/sss', data='1', params={'created': created})
 
+        r = self.request('GET', '/reports/sss/instances/stats', params={'bucket': 'hour'})
+        self.assertEqual(200, r.status_code)
+        result = r.json()['result']
+        self.assertEqual(3, result['count'])
+        self.assertEqual('2017-01-01T10:00:00', result['first'])
+        self.assertEqual('2017-01-01T12:00:00', result['last'])
+        self.assertEqual([2, 0, 1], [b['count'] for b in result['buckets']])
+
+        r = self.request('GET', '/reports/sss/instances/stats', params={'from': '2017-01-01T11:00:00'})
+        self.assertEqual(1, r.json()['result']['count'])
+        self.assertEqual(['2017-01-01T00:00:00'], [b['start'] for b in r.json()['result']['buckets']])
+
+    def test_delete_report_job(self):
+        count = apiconfig.DELETE_SYNC_LIMIT + 10
+        r = self.request('POST', '/reports/ddd/batch', data=json.dumps([str(i) for i in range(count)]))
+        self.assertEqual(count, r.json()['details']['created'])
+
+        r = self.request('DELETE', '/reports/ddd')
+        self.assertEqual(202, r.status_code)
+        job_id = r.json()['result']['id']
+        self.assertEqual(404, self.request('GET', '/reports/ddd/instances').status_code)
+
+        for _ in range(100):
+            r = self.request('GET', '/jobs/%s' % job_id)
+            if r.json()['result']['status'] not in ('pending', 'running'):
+                break
+            time.sleep(0.1)
+        self.assertEqual('done', r.json()['result']['status'])
+        self.assertGreater(r.json()['result']['progress']['deletedInstances'], 0)
+
+    def test_delete_instances_job_keeps_new_instances(self):
+        count = apiconfig.DELETE_SYNC_LIMIT + 10
+        r = self.request('POST', '/reports/ddd/batch', data=json.dumps([str(i) for i in range(count)]))
+        self.assertEqual(count, r.json()['details']['created'])
+
+        r = self.request('DELETE', '/reports/ddd/instances')
+        self.assertEqual(202, r.status_code)
+        job_id = r.json()['result']['id']
+        new_ids = [self.request('POST', '/reports/ddd', data='new').json()['result']['id']
+                   for i in range(3)]
+
+        for _ in range(100):
+            r = self.request('GET', '/jobs/%s' % job_id)
+            if r.json()['result']['status'] not in ('pending', 'running'):
+                break
+            time.sleep(0.1)
+        self.assertEqual('done', r.json()['result']['status'])
+        self.assertGreater(r.json()['result']['progress']['deletedInstances'], 0)
+
+        r = self.request('GET', '/reports/ddd/instances', params={'fields': 'id'})
+        self.assertEqual(new_ids, [ri['id'] for ri in r.json()['result']])
+
+    def test_ingest(self):
+        lines = [json.dumps({'report': 'ing1', 'input': '1'}),
+                 'not json',
+                 json.dumps({'report': 'ing2', 'input': {'c1': 1}, 'tags': 'p1:v1'}),
+                 json.dumps({'report': 'ing1', 'input': '2'})]
+        r = self.request('POST', '/ingest', data='\n'.join(lines))
+        self.assertEqual(200, r.status_code)
+        statuses = [json.loads(l) for l in r.text.splitlines()]
+        self.assertEqual([1, 2, 3, 4], [st['line'] for st in statuses])
+        self.assertEqual([True, False, True, True], [st['success'] for st in statuses])
+        self.assertEqual(['p1:v1'], statuses[2]['result']['tags'])
 
+        r = self.request('GET', '/reports/ing1/instances')
+        self.assertEqual(2, len(r.json()['result']))
+
+    def test_post_async(self):
+        r = self.request('POST', '/reports/ddd?async=1&tags=p1:v1', data='1')
+        self.assertEqual(202, r.status_code)
+        self.assertEqual(['p1:v1'], r.json()['result']['tags'])
+
+        for _ in range(50):
+            r_get = self.request('GET', '/reports/ddd/instances')
+            if r_get.json()['result']:
+                break
+            time.sleep(0.1)
+        self.assertEqual(1, len(r_get.json()['result']))
+        self.assertEqual(r.json()['result']['created'], r_get.json()['result'][0]['created'])
+
+    @unittest.skipUnless(apiconfig.METRICS_ENABLED, 'METRICS_ENABLED is not set')
+    def test_metrics(self):
+        self.test_post()
+        r = requests.get('%s/metrics' % apiconfig.BASE_URL_API)
+        self.assertEqual(200, r.status_code)
+        self.assertIn('mqeapi_requests_total{method="POST",route="/reports/<name>",status="200"}', r.text)
+        self.assertIn('mqeapi_phase_duration_seconds_count{phase="process_input"}', r.text)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = apicache.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_ttl(self):
+        cache = apicache.LRUCache(10, ttl=0.05)
+        cache.put('a', 1)
+        cache.put('b', None, ttl=10)
+        self.assertEqual(1, cache.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b', 'default'))
+
+    def test_invalidate(self):
+        cache = apicache.LRUCache(10)
+        cache.put('a', 1)
+        cache.invalidate('a')
+        self.assertEqual('x', cache.get('a', 'x'))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_store_eviction(self):
+        store = responsecache.LocalStore(max_bytes=10, ttl=10)
+        store.set('a', 'v1', 4)
+        store.set('b', 'v2', 4)
+        self.assertEqual('v1', store.get('a'))
+        store.set('c', 'v3', 4)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual('v1', store.get('a'))
+        self.assertEqual(8, store.size)
+
+        store.set('a', 'v4', 2)
+        self.assertEqual(6, store.size)
+        store.set('a', 'v5', 11)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(4, store.size)
+        store.delete('c')
+        self.assertEqual(0, store.size)
+
+    def test_store_ttl(self):
+        store = responsecache.LocalStore(max_bytes=10, ttl=0.05)
+        store.set('a', 'v1', 4)
+        self.assertEqual('v1', store.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(0, store.size)
+
+    def test_invalidate(self):
+        cache = responsecache.ResponseCache(responsecache.LocalStore(1024, 10))
+        args = MultiDict([('limit', '10'), ('tags', 'p1:v1')])
+        key = cache.key('o1', 'r1', 'k1', args)
+        self.assertEqual(key, cache.key('o1', 'r1', 'k1', MultiDict([('tags', 'p1:v1'), ('limit', '10')])))
+        other_key = cache.key('o1', 'r2', 'k1', args)
+        self.assertNotEqual(key, cache.key('o1', 'r1', 'k2', args))
+        self.assertNotEqual(key, other_key)
+
+        cache.put(key, 'data1', {'ETag': '"e1"'})
+        cache.put(other_key, 'data2', {'ETag': '"e2"'})
+        self.assertEqual(('data1', {'ETag': '"e1"'}), cache.get(key))
+
+        cache.invalidate('o1', 'r1')
+        self.assertIsNone(cache.get(cache.key('o1', 'r1', 'k1', args)))
+        self.assertEqual(('data2', {'ETag': '"e2"'}), cache.get(cache.key('o1', 'r2', 'k1', args)))
+        self.assertEqual(2, cache.stats()['hits'])
+        self.assertEqual(1, cache.stats()['misses'])
+
+    def test_disabled(self):
+        cache = responsecache.ResponseCache(None)
+        key = cache.key('o1', 'r1', 'k1', MultiDict())
+        cache.put(key, 'data', {})
+        self.assertIsNone(cache.get(key))
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        store = jobs.FileStore(60, self.directory)
+        job = jobs.Job(uuid.uuid4(), 'deleteReport', u'r\u2603', {'report_id': 'x'})
+        job.progress['deletedInstances'] = 10
+        store.put(job.key, job.state())
+
+        loaded = jobs.Job.from_state(jobs.FileStore(60, self.directory).get(job.key))
+        self.assertEqual(job.desc(), loaded.desc())
+        self.assertEqual(job.owner_id, loaded.owner_id)
+        self.assertEqual({'report_id': 'x'}, loaded.params)
+        self.assertEqual([job.key], store.keys('job-'))
+
+        store.delete(job.key)
+        self.assertIsNone(store.get(job.key))
+
+    def test_claim(self):
+        # the stores open the lock files separately, like different processes
+        store1 = jobs.FileStore(60, self.directory)
+        store2 = jobs.FileStore(60, self.directory)
+        self.assertTrue(store1.claim('job-1'))
+        self.assertFalse(store1.claim('job-1'))
+        self.assertFalse(store2.claim('job-1'))
+        store1.release('job-1')
+        self.assertTrue(store2.claim('job-1'))
+
+    def test_prune_keep(self):
+        store = jobs.FileStore(0, self.directory, keep=lambda key, value: value['status'] == 'running')
+        store.put('job-1', {'status': 'running'})
+        store.put('job-2', {'status': 'done'})
+        store._last_prune = 0
+        store._prune()
+        self.assertEqual(['job-1'], store.keys('job-'))
+
+    def test_hide_report(self):
+        owner_id = uuid.uuid4()
+        job = jobs.Job(owner_id, 'deleteReport', 'r1')
+        self.assertIsNone(jobs.hiding_job_id(owner_id, 'r1'))
+        jobs.hide_report(owner_id, 'r1', job)
+        self.assertEqual(job.job_id, jobs.hiding_job_id(owner_id, 'r1'))
+        self.assertIsNone(jobs.hiding_job_id(owner_id, 'r2'))
+        jobs.unhide_report(owner_id, 'r1')
+        self.assertIsNone(jobs.hiding_job_id(owner_id, 'r1'))
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+        self.errors = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def handleError(self, record):
+        self.errors.append(record)
+
+
+class AccessLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.handler = ListHandler()
+        accesslog.log.addHandler(self.handler)
+        self.level = accesslog.log.level
+        accesslog.log.setLevel(logging.INFO)
+        self.config = (apiconfig.ACCESS_LOG_COMBINED, apiconfig.ACCESS_LOG_SAMPLE_RATE,
+                       apiconfig.ACCESS_LOG_SLOW_MS)
+
+    def tearDown(self):
+        accesslog.log.removeHandler(self.handler)
+        accesslog.log.setLevel(self.level)
+        apiconfig.ACCESS_LOG_COMBINED, apiconfig.ACCESS_LOG_SAMPLE_RATE, \
+            apiconfig.ACCESS_LOG_SLOW_MS = self.config
+
+    def log_request(self, status, duration=0):
+        with self.app.test_request_context('/reports/r1', environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            accesslog.request_started()
+            accesslog.g.request_start_time -= duration
+            accesslog.request_finished(Response('abc', status=status))
+        return [r.getMessage() for r in self.handler.records]
+
+    def test_combined(self):
+        apiconfig.ACCESS_LOG_COMBINED = True
+        apiconfig.ACCESS_LOG_SAMPLE_RATE = 1.0
+        messages = self.log_request(200)
+        self.assertEqual(1, len(messages))
+        self.assertTrue(messages[0].startswith('HTTP GET http://localhost/reports/r1 200 ('))
+        self.assertTrue(messages[0].endswith(') 10.0.0.1 3'))
+
+    def test_sampling(self):
+        apiconfig.ACCESS_LOG_COMBINED = True
+        apiconfig.ACCESS_LOG_SAMPLE_RATE = 0.0
+        apiconfig.ACCESS_LOG_SLOW_MS = 1000
+        self.assertEqual([], self.log_request(200))
+        self.assertEqual(1, len(self.log_request(404)))
+        self.assertEqual(2, len(self.log_request(500)))
+        self.assertEqual(3, len(self.log_request(200, duration=2)))
+
+    def test_async_writer_drops(self):
+        writer = accesslog.AsyncLogWriter(1)
+        entered = threading.Event()
+        release = threading.Event()
+
+        class BlockingHandler(ListHandler):
+            def emit(self, record):
+                entered.set()
+                release.wait(5)
+                ListHandler.emit(self, record)
+
+        handler = BlockingHandler()
+        records = [logging.LogRecord('t', logging.INFO, '', 0, 'm%s' % i, None, None) for i in range(3)]
+        writer.submit([handler], records[0])
+        self.assertTrue(entered.wait(5))
+        writer.submit([handler], records[1])
+        writer.submit([handler], records[2])
+        self.assertEqual(1, writer.dropped)
+        release.set()
+        writer.flush()
+        self.assertEqual(records[:2], handler.records)
+
+    def test_async_writer_handler_error(self):
+        class FailingHandler(ListHandler):
+            def emit(self, record):
+                raise IOError('no space left')
+
+        writer = accesslog.AsyncLogWriter(10)
+        failing = FailingHandler()
+        handler = ListHandler()
+        record = logging.LogRecord('t', logging.INFO, '', 0, 'm', None, None)
+        writer.submit([failing, handler], record)
+        writer.flush()
+        self.assertEqual([record], failing.errors)
+        self.assertEqual([record], handler.records)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_rate_limit(self):
+        controller = admission.AdmissionController(rate=1, burst=2)
+        self.assertIsNone(controller.admit('o1'))
+        self.assertIsNone(controller.admit('o1'))
+        rejection = controller.admit('o1')
+        self.assertEqual(429, rejection.status)
+        self.assertEqual(1, rejection.retry_after)
+        self.assertIsNone(controller.admit('o2'))
+
+    def test_concurrency_limit(self):
+        controller = admission.AdmissionController(owner_concurrency=1, total_concurrency=2)
+        self.assertIsNone(controller.admit('o1'))
+        self.assertEqual(429, controller.admit('o1').status)
+        self.assertIsNone(controller.admit('o2'))
+        self.assertEqual(503, controller.admit('o3').status)
+        controller.release('o1')
+        self.assertEqual(0, controller.owner_in_flight('o1'))
+        self.assertIsNone(controller.admit('o3'))
+        self.assertEqual(2, controller.stats()['inFlight'])
+
+
+class ApiResponseTest(unittest.TestCase):
+
+    def test_serialize_same_as_envelope(self):
+        resps = [responses.ApiResponse(200, result=[1, {'a': u'\u2603'}]),
+                 responses.ApiResponse(404, message='Not found'),
+                 responses.ApiResponse(200),
+                 responses.ApiResponse(202, success=True, details_pairs=[('next', None)]),
+                 responses.ApiResponse(400, details_pairs=[('next', 'x'), ('message', 'm')])]
+        for r in resps:
+            self.assertEqual(serialize.json_dumps_external(r.envelope()), r.serialize())
+
+    def test_streaming_same_as_envelope(self):
+        items = [1, {'a': u'\u2603'}, None]
+        r = responses.StreamingApiResponse(200, iter(items),
+                                           details_callback=lambda r: r.set_detail('next', None))
+        r.success = True
+        envelope = OrderedDict([('success', True), ('result', items), ('details', {'next': None})])
+        self.assertEqual(serialize.json_dumps_external(envelope), ''.join(r._generate()))
@@ -1,16 +1,35 @@
 from collections import OrderedDict
 import logging
-
-from flask import Blueprint, request, g
+import json
+import uuid
+import datetime
+import time
+import Queue
+import StringIO
+import csv
+
+from flask import Blueprint, request, g, stream_with_context
+from werkzeug.wrappers import Response
+from werkzeug.http import unquote_etag
 
 from mqetables import parseany
 from mqe import reports
-from mqe.util import uuid_for_prev_dt, uuid_for_next_dt
+from mqe.util import uuid_for_prev_dt, uuid_for_next_dt, datetime_from_uuid1, uniq_sameorder
 from mqe import mqeconfig
-
-from mqeapi.responses import ApiResponse, bad_request
+from mqe import serialize
+
+from mqeapi.responses import ApiResponse, StreamingApiResponse, ExceptionalResponse, \
+    bad_request, json_line, service_unavailable, not_modified
+from mqeapi.ingestqueue import ingest_queue
+from mqeapi.responsecache import response_cache
+from mqeapi import jobs
+from mqeapi import cursors
+from mqeapi import notify
+from mqeapi.cooperative import offload
 from mqeapi.apiutil import *
 from mqeapi import apiconfig
+from mqeapi import compression
+from mqeapi import metrics
 
 
 log = logging.getLogger('mqeapi.views')
@@ -21,49 +40,209 @@ bp_api = Blueprint('bp_api', 'mqeapi.views')
 
 @bp_api.route('/reports', methods=['GET'])
 def get_reports():
-    prefix = parse_string(request.args.get('prefix'))
-    last_name = parse_string(request.args.get('lastName'))
-    limit = get_limit()
+    cursor = request.args.get('cursor')
+    if cursor:
+        st = parse_cursor(cursor, 'reports', required=('l', 'n'))
+        prefix, last_name, limit = st.get('p'), st['n'], st['l']
+    else:
+        prefix = parse_string(request.args.get('prefix'))
+        last_name = parse_string(request.args.get('lastName'))
+        limit = get_limit()
 
-    report_list = reports.fetch_reports_by_name(g.owner_id, prefix, last_name, limit)
+    report_list = offload(reports.fetch_reports_by_name, g.owner_id, prefix, last_name, limit)
 
     r = ApiResponse(200)
     r.result = [OrderedDict([('name', report.report_name),
                              ('href', href('/reports/%s' % report.report_name))])
-                for report in report_list]
+                for report in report_list
+                if not report_being_deleted(g.owner_id, report.report_name)]
 
     if len(report_list) == limit:
-        r.set_detail('next', set_query_param(request.url, 'lastName',
-                                             report_list[-1][ 'report_name']))
+        next_state = OrderedDict([('k', 'reports'), ('p', prefix), ('l', limit),
+                                  ('n', report_list[-1].report_name)])
+        r.set_detail('next', cursor_href('/reports', next_state))
     else:
         r.set_detail('next', None)
 
     return r.get()
 
-def _report_instance_desc(report_name, ri, expand, expand_input):
+def _report_instance_desc(report_name, ri, expand, expand_input, fields=None):
+    if fields is not None:
+        # the rows and the input are computed only when requested
+        expand = 'rows' in fields or 'header' in fields
+        expand_input = 'input' in fields
     desc = ri.desc(expand, expand_input)
     desc['href'] = href('/reports/%s/instances/%s' % (report_name,
                                                       ri.report_instance_id.hex))
+    if fields is not None:
+        desc = OrderedDict((k, v) for k, v in desc.items() if k in fields)
     return desc
 
+@bp_api.route('/latest', methods=['GET'])
+def get_latest_instances():
+    names = parse_string(request.args.get('reports'))
+    prefix = parse_string(request.args.get('prefix'))
+    if names:
+        names = uniq_sameorder([n.strip() for n in names.split(',') if n.strip()])
+    elif prefix is None:
+        return bad_request('Either the reports or the prefix parameter is required').get()
+    expand = parse_bool(request.args.get('expand'))
+    if expand is None:
+        expand = True
+    expand_input = parse_bool(request.args.get('expandInput')) or False
+    fields = parse_fields(request.args.get('fields'))
+
+    if names:
+        if len(names) > apiconfig.MAX_LATEST_REPORTS:
+            return bad_request('Too many reports, maximum is %s' % apiconfig.MAX_LATEST_REPORTS).get()
+        # the reports are selected by the fetching threads
+        report_list = [None] * len(names)
+    else:
+        limit = get_limit(apiconfig.MAX_LATEST_REPORTS)
+        report_list = offload(reports.fetch_reports_by_name, g.owner_id, prefix, None, limit)
+        report_list = [report for report in report_list
+                       if not report_being_deleted(g.owner_id, report.report_name)]
+        names = [report.report_name for report in report_list]
+
+    owner_id = g.owner_id
+
+    def fetch_latest((name, report)):
+        if report is None:
+            report = select_report(owner_id, name)
+            if report is None:
+                return None, None
+        with metrics.timed('dao_fetch'):
+            instances = offload(report.fetch_instances, order='desc', limit=1)
+        return report, instances[0] if instances else None
+
+    report_list, latest = zip(*map_concurrently(fetch_latest, zip(names, report_list))) or ((), ())
+
+    r = ApiResponse(200)
+    r.result = [OrderedDict([('name', name),
+                             ('href', href('/reports/%s' % name)),
+                             ('instance', _report_instance_desc(name, ri, expand, expand_input, fields)
+                                          if ri else None)])
+                for name, ri in zip(names, latest)]
+    r.set_detail('notFound', [name for name, report in zip(names, report_list) if report is None])
+    return r.get()
+
+
 @bp_api.route('/reports/<name>/instances', methods=['GET'])
 def get_report_instances(name):
-    from_dt = parse_datetime(request.args.get('from'))
-    to_dt = parse_datetime(request.args.get('to'))
-    tags = parse_tags(request.args.get('tags'))
+    if request.args.get('ids') is not None:
+        return _get_report_instances_by_ids(name, request.args['ids'].split(','))
+
+    cursor = request.args.get('cursor')
+    q = _instances_query_from_cursor(name, cursor) if cursor else _instances_query_from_args()
+
+    cache_key = None
+    if not q['stream']:
+        cache_key = response_cache.key(g.owner_id, name, g.api_key, request.args)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return _cached_listing_response(*cached)
+
+    report = get_report(name)
+
+    fetch_kwargs = dict(from_dt=q['from_dt'], to_dt=q['to_dt'], tags=q['tags'], order=q['order'],
+                        after=q['after'], before=q['before'])
+    if q['stream']:
+        return _stream_report_instances(name, report, q, fetch_kwargs)
+
+    instances = None
+    if cursor and apiconfig.CURSOR_PREFETCH:
+        instances = cursors.take_prefetched((report.report_id, cursor))
+    if instances is None:
+        with metrics.timed('dao_fetch'):
+            instances = offload(report.fetch_instances, limit=q['limit'], **fetch_kwargs)
+
+    # the listed instances are immutable, so the ids identify the response
+    etag = listing_etag(instances)
+    headers = etag_headers(etag, weak=True, cache_control=apiconfig.LISTING_CACHE_CONTROL)
+    if is_not_modified(etag):
+        return not_modified(headers)
+
+    res = [_report_instance_desc(name, ri, q['expand'], q['expand_input'], q['fields'])
+           for ri in instances]
+    r = ApiResponse(200, result=res, headers=headers)
+    if len(instances) == q['limit']:
+        next_state = _instances_cursor_state(name, q, instances[-1].report_instance_id)
+        r.set_detail('next', cursor_href('/reports/%s/instances' % name, next_state))
+        if cursor and apiconfig.CURSOR_PREFETCH:
+            # the client is iterating over the pages, fetch the next one in advance
+            next_q = _instances_query_from_state(next_state)
+            cursors.prefetch((report.report_id, cursors.encode(next_state, g.api_key)),
+                             offload, report.fetch_instances, limit=q['limit'],
+                             from_dt=next_q['from_dt'], to_dt=next_q['to_dt'], tags=next_q['tags'],
+                             order=next_q['order'], after=next_q['after'], before=next_q['before'])
+    else:
+        r.set_detail('next', None)
+
+    resp = r.get()
+    if resp.status_code == 200:
+        response_cache.put(cache_key, resp.get_data(), headers)
+    return resp
+
+@bp_api.route('/reports/<name>/instances', methods=['POST'])
+def post_report_instances_ids(name):
+    data = compression.request_data()
+    try:
+        ids = serialize.json_loads(data)
+    except:
+        return bad_request('Invalid JSON').get()
+    if isinstance(ids, dict):
+        ids = ids.get('ids')
+    if not isinstance(ids, list):
+        return bad_request('The body must be a JSON array of ids or an object with the ids key').get()
+    return _get_report_instances_by_ids(name, ids)
+
+def _get_report_instances_by_ids(name, id_strings):
+    ids = [parse_id(unicode(s)) for s in id_strings if unicode(s).strip()]
+    if not ids:
+        return bad_request('No ids passed').get()
+    if len(ids) > apiconfig.MAX_GET_IDS:
+        return bad_request('Too many ids, maximum is %s' % apiconfig.MAX_GET_IDS).get()
 
     expand = parse_bool(request.args.get('expand'))
     if expand is None:
         expand = True
-
     expand_input = parse_bool(request.args.get('expandInput')) or False
-    limit = get_limit()
-    from_id = parse_id(request.args.get('fromId'))
-    last_id = parse_id(request.args.get('lastId'))
-    order = parse_enum(request.args.get('order'), ('asc', 'desc')) or 'asc'
+    fields = parse_fields(request.args.get('fields'))
 
     report = get_report(name)
 
+    # mqe doesn't support fetching instances by a list of ids, each distinct id
+    # is fetched separately
+    found = {}
+    with metrics.timed('dao_fetch'):
+        for report_instance_id in uniq_sameorder(ids):
+            ri = offload(report.fetch_single_instance, report_instance_id)
+            if ri:
+                found[report_instance_id] = ri
+
+    r = ApiResponse(200)
+    r.result = [_report_instance_desc(name, found[id], expand, expand_input, fields)
+                if id in found else None for id in ids]
+    r.set_detail('notFound', uniq_sameorder([to_id(id) for id in ids if id not in found]))
+    return r.get()
+
+def _instances_query_from_args():
+    q = {}
+    q['from_dt'] = parse_datetime(request.args.get('from'))
+    q['to_dt'] = parse_datetime(request.args.get('to'))
+    q['tags'] = parse_tags(request.args.get('tags'))
+
+    expand = parse_bool(request.args.get('expand'))
+    q['expand'] = expand if expand is not None else True
+
+    q['expand_input'] = parse_bool(request.args.get('expandInput')) or False
+    q['fields'] = parse_fields(request.args.get('fields'))
+    q['stream'] = parse_bool(request.args.get('stream')) or False
+    q['limit'] = get_limit(apiconfig.MAX_STREAM_GET_LIMIT if q['stream'] else apiconfig.MAX_GET_LIMIT)
+    from_id = parse_id(request.args.get('fromId'))
+    last_id = parse_id(request.args.get('lastId'))
+    q['order'] = order = parse_enum(request.args.get('order'), ('asc', 'desc')) or 'asc'
+
     after = None
     before = None
     if last_id:
@@ -80,45 +259,305 @@ def get_report_instances(name):
         elif order == 'desc':
             after = None
             before = uuid_for_next_dt(from_id)
+    q['after'] = after
+    q['before'] = before
+    return q
+
+def _instances_query_from_cursor(name, cursor):
+    return _instances_query_from_state(parse_cursor(cursor, 'instances', name))
+
+def _instances_query_from_state(st):
+    # the state is validated by parse_cursor
+    return {
+        'from_dt': cursors.micros_to_dt(st.get('f')),
+        'to_dt': cursors.micros_to_dt(st.get('t')),
+        'tags': st.get('g'),
+        'expand': st.get('e', True),
+        'expand_input': st.get('i', False),
+        'fields': set(st['fl']) if st.get('fl') is not None else None,
+        'stream': st.get('s', False),
+        'limit': st['l'],
+        'order': st.get('o', 'asc'),
+        'after': uuid.UUID(st['a']) if st.get('a') else None,
+        'before': uuid.UUID(st['b']) if st.get('b') else None,
+    }
+
+def _instances_cursor_state(name, q, last_id):
+    """Return the state of a cursor continuing the query ``q`` after the ``last_id``"""
+    st = OrderedDict([
+        ('k', 'instances'),
+        ('r', name),
+        ('f', cursors.dt_to_micros(q['from_dt'])),
+        ('t', cursors.dt_to_micros(q['to_dt'])),
+        ('g', q['tags']),
+        # parse_bool returns ints, the state holds bools
+        ('e', bool(q['expand'])),
+        ('i', bool(q['expand_input'])),
+        ('fl', sorted(q['fields']) if q['fields'] is not None else None),
+        ('s', bool(q['stream'])),
+        ('l', q['limit']),
+        ('o', q['order']),
+        ('a' if q['order'] == 'asc' else 'b', last_id.hex),
+    ])
+    return OrderedDict((k, v) for k, v in st.items() if v is not None)
+
+def _cached_listing_response(data, headers):
+    etag, _ = unquote_etag(headers['ETag'])
+    if is_not_modified(etag):
+        return not_modified(headers)
+    return Response(data, headers=headers, mimetype='application/json')
+
+def _stream_report_instances(name, report, q, fetch_kwargs):
+    state = {'count': 0, 'last_id': None}
+
+    def descs():
+        for ri in iter_instances(report, limit=q['limit'], chunk_size=apiconfig.STREAM_FETCH_SIZE,
+                                 **fetch_kwargs):
+            state['count'] += 1
+            state['last_id'] = ri.report_instance_id
+            yield _report_instance_desc(name, ri, q['expand'], q['expand_input'], q['fields'])
+
+    def set_next(r):
+        if state['count'] == q['limit']:
+            r.set_detail('next', cursor_href('/reports/%s/instances' % name,
+                                             _instances_cursor_state(name, q, state['last_id'])))
+        else:
+            r.set_detail('next', None)
 
-    instances = report.fetch_instances(from_dt=from_dt, to_dt=to_dt, limit=limit, tags=tags,
-                                       order=order, after=after, before=before)
+    return StreamingApiResponse(200, descs(), set_next).get()
 
-    res = [_report_instance_desc(name, ri, expand, expand_input) for ri in instances]
-    r = ApiResponse(200, result=res)
-    if len(instances) == limit:
-        r.set_detail('next', set_query_param(request.url, 'lastId',
-                                             to_id(instances[-1].report_instance_id)))
+
+def _csv_value(v):
+    if v is None:
+        return ''
+    if isinstance(v, (list, dict)):
+        v = serialize.json_dumps_external(v)
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return str(v)
+
+def _export_csv_lines(desc, buf, writer):
+    buf.seek(0)
+    buf.truncate()
+    prefix = [desc['id'], desc['created'], ','.join(desc['tags'])]
+    for row in desc.get('rows') or []:
+        writer.writerow([_csv_value(v) for v in prefix + list(row)])
+    return buf.getvalue()
+
+EXPORT_ERROR_MARKER = '#error'
+EXPORT_ERROR_MESSAGE = 'Export interrupted by an internal error'
+
+@bp_api.route('/reports/<name>/export', methods=['GET'])
+def export_report_instances(name):
+    from_dt = parse_datetime(request.args.get('from'))
+    to_dt = parse_datetime(request.args.get('to'))
+    tags = parse_tags(request.args.get('tags'))
+    expand_input = parse_bool(request.args.get('expandInput')) or False
+    fields = parse_fields(request.args.get('fields'))
+    export_format = parse_enum(request.args.get('format'), ('ndjson', 'csv')) or 'ndjson'
+
+    report = get_report(name)
+
+    def generate():
+        instances = iter_instances(report, from_dt=from_dt, to_dt=to_dt, tags=tags,
+                                   chunk_size=apiconfig.EXPORT_FETCH_SIZE)
+        buf = StringIO.StringIO()
+        writer = csv.writer(buf)
+        try:
+            if export_format == 'csv':
+                yield 'id,created,tags,cells\r\n'
+                for ri in instances:
+                    yield _export_csv_lines(ri.desc(True, False), buf, writer)
+            else:
+                for ri in instances:
+                    yield json_line(_report_instance_desc(name, ri, True, expand_input, fields))
+        except Exception:
+            log.exception('Error when exporting report instances')
+            # the status is already sent, the last line tells the client that the export is incomplete
+            if export_format == 'csv':
+                buf.seek(0)
+                buf.truncate()
+                writer.writerow([EXPORT_ERROR_MARKER, '', '', EXPORT_ERROR_MESSAGE])
+                yield buf.getvalue()
+            else:
+                yield json_line(ApiResponse(500, message=EXPORT_ERROR_MESSAGE,
+                                            error_code='ERROR_EXPORT_INCOMPLETE').envelope())
+
+    if export_format == 'csv':
+        mimetype = 'text/csv'
     else:
-        r.set_detail('next', None)
+        mimetype = 'application/x-ndjson'
+    headers = {'Content-Disposition': 'attachment; filename="%s.%s"' % (
+        name.encode('ascii', 'replace').replace('"', '_'), export_format)}
+    return Response(stream_with_context(generate()), headers=headers, mimetype=mimetype)
+
+
+def _bucket_start(dt, bucket):
+    if bucket == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+@bp_api.route('/reports/<name>/instances/stats', methods=['GET'])
+def get_report_instances_stats(name):
+    from_dt = parse_datetime(request.args.get('from'))
+    to_dt = parse_datetime(request.args.get('to'))
+    tags = parse_tags(request.args.get('tags'))
+    bucket = parse_enum(request.args.get('bucket'), ('hour', 'day')) or 'day'
+
+    report = get_report(name)
+
+    # only the ids are fetched, the creation datetimes are taken from them
+    counts = OrderedDict()
+    first = last = None
+    count = 0
+    for ri in iter_instances(report, from_dt=from_dt, to_dt=to_dt, tags=tags,
+                             limit=apiconfig.MAX_STATS_INSTANCES,
+                             chunk_size=apiconfig.STATS_FETCH_SIZE, columns=['report_instance_id']):
+        created = datetime_from_uuid1(ri.report_instance_id)
+        if first is None:
+            first = created
+        last = created
+        start = _bucket_start(created, bucket)
+        counts[start] = counts.get(start, 0) + 1
+        count += 1
+
+    buckets = []
+    if first is not None:
+        step = datetime.timedelta(hours=1) if bucket == 'hour' else datetime.timedelta(days=1)
+        start = _bucket_start(first, bucket)
+        while start <= last:
+            buckets.append(OrderedDict([('start', start.isoformat()), ('count', counts.get(start, 0))]))
+            start += step
+
+    r = ApiResponse(200)
+    r.result_pairs = [('count', count),
+                      ('first', first.isoformat() if first else None),
+                      ('last', last.isoformat() if last else None),
+                      ('bucket', bucket),
+                      ('buckets', buckets)]
+    r.set_detail('truncated', count == apiconfig.MAX_STATS_INSTANCES)
     return r.get()
 
 
+@bp_api.route('/reports/<name>/instances/watch', methods=['GET'])
+def watch_report_instances(name):
+    after_id = parse_id(request.args.get('afterId') or request.headers.get('Last-Event-ID'))
+    timeout = parse_int(request.args.get('timeout'))
+    if timeout is None:
+        timeout = apiconfig.WATCH_DEFAULT_TIMEOUT
+    if not 0 <= timeout <= apiconfig.WATCH_MAX_TIMEOUT:
+        return bad_request('Invalid timeout <%s>: must be between 0 and %s' % (
+            timeout, apiconfig.WATCH_MAX_TIMEOUT)).get()
+    expand = parse_bool(request.args.get('expand'))
+    if expand is None:
+        expand = True
+    expand_input = parse_bool(request.args.get('expandInput')) or False
+    fields = parse_fields(request.args.get('fields'))
+    sse = parse_bool(request.args.get('sse'))
+    if sse is None:
+        sse = request.accept_mimetypes.best == 'text/event-stream'
+
+    report = get_report(name)
+    if after_id is None:
+        # watch only the instances created from now on
+        with metrics.timed('dao_fetch'):
+            latest = offload(report.fetch_instances, order='desc', limit=1)
+        after_id = latest[0].report_instance_id if latest else None
+
+    def desc(ri):
+        return _report_instance_desc(name, ri, expand, expand_input, fields)
+
+    # a waiting request would occupy a concurrency slot for up to WATCH_SSE_MAX_DURATION
+    release_admission()
+    if sse:
+        return _watch_events(report, after_id, desc)
+
+    limit = get_limit()
+    deadline = time.time() + timeout
+    with notify.hub.subscribe((g.owner_id, name)) as subscription:
+        while True:
+            version = subscription.version
+            with metrics.timed('dao_fetch'):
+                instances = offload(report.fetch_instances, after=after_id, limit=limit)
+            remaining = deadline - time.time()
+            if instances or remaining <= 0:
+                break
+            subscription.wait(version, min(remaining, apiconfig.WATCH_RECHECK_INTERVAL))
+
+    if instances:
+        after_id = instances[-1].report_instance_id
+    r = ApiResponse(200, result=[desc(ri) for ri in instances])
+    r.set_detail('lastId', to_id(after_id) if after_id else None)
+    return r.get()
+
+def _watch_events(report, after_id, desc):
+    """Return a response streaming server-sent events of new report instances"""
+    def generate():
+        last_id = after_id
+        deadline = time.time() + apiconfig.WATCH_SSE_MAX_DURATION
+        last_sent = time.time()
+        with notify.hub.subscribe((report.owner_id, report.report_name)) as subscription:
+            while time.time() < deadline:
+                version = subscription.version
+                for ri in iter_instances(report, after=last_id, chunk_size=apiconfig.STREAM_FETCH_SIZE):
+                    last_id = ri.report_instance_id
+                    yield 'id: %s\nevent: instance\ndata: %s\n' % (to_id(last_id), json_line(desc(ri)))
+                    last_sent = time.time()
+                if time.time() - last_sent >= apiconfig.WATCH_SSE_HEARTBEAT:
+                    # keeps proxies from closing the idle connection
+                    yield ': heartbeat\n\n'
+                    last_sent = time.time()
+                subscription.wait(version, min(apiconfig.WATCH_RECHECK_INTERVAL,
+                                               apiconfig.WATCH_SSE_HEARTBEAT))
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), headers=headers, mimetype='text/event-stream')
+
+
 @bp_api.route('/reports/<name>/instances/<id>', methods=['GET'])
 def get_single_report_instance(name, id):
     report_instance_id = parse_id(id)
+    fields = parse_fields(request.args.get('fields'))
 
     report = get_report(name)
-    ri = report.fetch_single_instance(report_instance_id)
+    with metrics.timed('dao_fetch'):
+        ri = offload(report.fetch_single_instance, report_instance_id)
     if not ri:
         return ApiResponse(404, message='Report instance with id <%s> not found' % to_id(report_instance_id)).get()
-    return ApiResponse(200, result=_report_instance_desc(name, ri, True, True)).get()
+
+    etag = to_id(report_instance_id)
+    if fields is not None:
+        etag += '-' + '.'.join(sorted(fields))
+    headers = etag_headers(etag, cache_control=apiconfig.INSTANCE_CACHE_CONTROL)
+    if is_not_modified(etag):
+        return not_modified(headers)
+    return ApiResponse(200, result=_report_instance_desc(name, ri, True, True, fields),
+                       headers=headers).get()
 
 
 @bp_api.route('/reports/<name>', methods=['DELETE'])
 def delete_report(name):
     report = get_report(name)
-    report.delete_multiple_instances()
-    report.delete()
+    if has_more_instances(report, apiconfig.DELETE_SYNC_LIMIT):
+        # the report is hidden right away and deleted by a job after deleting the instances,
+        # so that a resumed job can still find the instances
+        resp = _start_delete_job('deleteReport', report, name)
+    else:
+        offload(report.delete_multiple_instances)
+        offload(report.delete)
+        resp = ApiResponse(200)
+    invalidate_report(g.owner_id, name)
+    response_cache.invalidate(g.owner_id, name)
 
-    return ApiResponse(200).get()
+    return resp.get()
 
 
 @bp_api.route('/reports/<name>/instances/<id>', methods=['DELETE'])
 def delete_single_report_instance(name, id):
     report_instance_id = parse_id(id)
     report = get_report(name)
-    report.delete_single_instance(report_instance_id)
+    offload(report.delete_single_instance, report_instance_id)
+    response_cache.invalidate(g.owner_id, name)
     return ApiResponse(200).get()
 
 
@@ -129,11 +568,79 @@ def delete_multiple_report_instances(name):
     tags = parse_tags(request.args.get('tags'))
 
     report = get_report(name)
-    report.delete_multiple_instances(from_dt=from_dt, to_dt=to_dt, tags=tags)
+    if has_more_instances(report, apiconfig.DELETE_SYNC_LIMIT, from_dt, to_dt, tags):
+        return _start_delete_job('deleteInstances', report, name, from_dt, to_dt, tags).get()
+
+    offload(report.delete_multiple_instances, from_dt=from_dt, to_dt=to_dt, tags=tags)
+    response_cache.invalidate(g.owner_id, name)
 
     return ApiResponse(200).get()
 
 
+def _start_delete_job(kind, report, name, from_dt=None, to_dt=None, tags=None):
+    job = jobs.Job(g.owner_id, kind, name, {'report_id': unicode(report.report_id)})
+    if kind == 'deleteInstances':
+        # instances created after accepting the request are kept, like by a synchronous
+        # delete. The bound is saved in the job's params, so a resumed job uses it too.
+        job.params.update(from_micros=cursors.dt_to_micros(from_dt),
+                          to_micros=cursors.dt_to_micros(to_dt or job.created), tags=tags)
+    if kind == 'deleteReport':
+        jobs.hide_report(g.owner_id, name, job)
+    try:
+        jobs.submit(job)
+    except Queue.Full:
+        if kind == 'deleteReport':
+            jobs.unhide_report(g.owner_id, name)
+        raise ExceptionalResponse(service_unavailable('Too many running jobs, retry later',
+                                                      apiconfig.ASYNC_INGEST_RETRY_AFTER))
+    return ApiResponse(202, success=True, result=job.desc(),
+                       headers={'Location': href('/jobs/%s' % to_id(job.job_id))})
+
+def _job_report(job, report_id):
+    # a resumed job can find the report already deleted
+    report = offload(reports.Report.select_by_name, job.owner_id, job.report_name)
+    if report is None or unicode(report.report_id) != report_id:
+        return None
+    return report
+
+def _delete_chunks(job, report, from_dt=None, to_dt=None, tags=None):
+    job.progress.setdefault('deletedInstances', 0)
+    for deleted in delete_instances_in_chunks(report, from_dt, to_dt, tags):
+        job.progress['deletedInstances'] += deleted
+        job.save()
+        response_cache.invalidate(job.owner_id, job.report_name)
+        job.check_interrupted()
+        # leave the database to other requests
+        time.sleep(apiconfig.DELETE_CHUNK_PAUSE)
+    response_cache.invalidate(job.owner_id, job.report_name)
+
+def _delete_report_job(job, report_id):
+    report = _job_report(job, report_id)
+    if report is not None:
+        _delete_chunks(job, report)
+        offload(report.delete)
+    jobs.unhide_report(job.owner_id, job.report_name)
+    invalidate_report(job.owner_id, job.report_name)
+    response_cache.invalidate(job.owner_id, job.report_name)
+
+def _delete_instances_job(job, report_id, from_micros, to_micros, tags):
+    report = _job_report(job, report_id)
+    if report is not None:
+        _delete_chunks(job, report, cursors.micros_to_dt(from_micros), cursors.micros_to_dt(to_micros),
+                       tags)
+
+jobs.register('deleteReport', _delete_report_job)
+jobs.register('deleteInstances', _delete_instances_job)
+
+
+@bp_api.route('/jobs/<id>', methods=['GET'])
+def get_job(id):
+    job = jobs.get_job(g.owner_id, parse_id(id))
+    if job is None:
+        return ApiResponse(404, message='Job with id <%s> not found' % id).get()
+    return ApiResponse(200, result=job.desc()).get()
+
+
 def format_from_headers():
     try:
         if not request.mimetype:
@@ -149,80 +656,305 @@ def format_from_headers():
     except:
         return None
 
-@bp_api.route('/reports/<name>', methods=['POST'])
-def post_report_instance(name):
-    form_key = request.args.get('formKey')
-    if form_key:
-        input_string = request.form.get(form_key)
-    else:
-        input_string = request.get_data()
-
-    tags = parse_tags(request.args.get('tags'))
-    created = parse_datetime(request.args.get('created'))
-    input_type = parse_enum(request.args.get('format'),
-                         [k for k in parseany.INPUT_PARSERS if not k.startswith('_')]) \
-                or format_from_headers() \
-                or 'any'
-    force_header = parse_int_tags(request.args.get('header'))
-    delimiter = parse_string(request.args.get('delimiter'))
-    autotags = parse_enum(request.args.get('autotags'), ['ip'])
-    link = parse_string(request.args.get('link'))
+INPUT_OPTION_KEYS = ('tags', 'created', 'format', 'header', 'delimiter', 'autotags', 'link')
+
+def _input_types():
+    return [k for k in parseany.INPUT_PARSERS if not k.startswith('_')]
+
+def _parse_input_options(params):
+    """Parse the options of a submitted input, passed as a dict-like ``params``
+    mapping the query parameter names to string values"""
+    return {
+        'tags': parse_tags(params.get('tags')),
+        'created': parse_datetime(params.get('created')),
+        'input_type': parse_enum(params.get('format'), _input_types()),
+        'force_header': parse_int_tags(params.get('header')),
+        'delimiter': parse_string(params.get('delimiter')),
+        'autotags': parse_enum(params.get('autotags'), ['ip']),
+        'link': parse_string(params.get('link')),
+    }
 
+def _check_input(input_string, opts):
+    """Validate the input and the parsed options, computing autotags. An invalid
+    input or option raises :class:`ExceptionalResponse`."""
     ### check for empty input
     if not input_string or input_string.isspace():
-        return ApiResponse(422, message='Empty report data', error_code='ERROR_EMPTY_REPORT_DATA').get()
+        raise ExceptionalResponse(ApiResponse(422, message='Empty report data', error_code='ERROR_EMPTY_REPORT_DATA'))
 
     ### autotags
-    if autotags and 'ip' in autotags:
-        if (not tags) or 'ip' not in tags:
-            tags = tags or []
+    if opts['autotags'] and 'ip' in opts['autotags']:
+        if (not opts['tags']) or 'ip' not in opts['tags']:
+            opts['tags'] = opts['tags'] or []
             ip_address = client_ip()
             if ip_address:
-                tags.append('ip:%s' % ip_address)
+                opts['tags'].append('ip:%s' % ip_address)
 
+    tags = opts['tags']
     if tags:
         if len(tags) > mqeconfig.MAX_TAGS:
-            return bad_request('Too many tags, maximum is %s' % mqeconfig.MAX_TAGS).get()
+            raise ExceptionalResponse.bad_request('Too many tags, maximum is %s' % mqeconfig.MAX_TAGS)
         if any(len(t) > apiconfig.SIMPLE_VALUE_LEN_LIMIT for t in tags):
-            return bad_request('Tag value too long').get()
+            raise ExceptionalResponse.bad_request('Tag value too long')
 
-    if delimiter:
-        if len(delimiter) > apiconfig.SIMPLE_VALUE_LEN_LIMIT:
-            return bad_request('Delimiter value too long').get()
+    if opts['delimiter']:
+        if len(opts['delimiter']) > apiconfig.SIMPLE_VALUE_LEN_LIMIT:
+            raise ExceptionalResponse.bad_request('Delimiter value too long')
 
-    if link:
-        if len(link) > apiconfig.USER_VALUE_LEN_LIMIT:
-            return bad_request('Link value too long').get()
-
-    ip_options = {
-        'delimiter': delimiter
-    }
+    if opts['link']:
+        if len(opts['link']) > apiconfig.USER_VALUE_LEN_LIMIT:
+            raise ExceptionalResponse.bad_request('Link value too long')
 
+def _select_or_insert_report(name):
     # select or create report, check name validity
     if not name:
-        return bad_request('Empty report name').get()
+        raise ExceptionalResponse.bad_request('Empty report name')
     if len(name) > apiconfig.SIMPLE_VALUE_LEN_LIMIT:
-        return bad_request('Report name too long').get()
-    report = reports.Report.select_or_insert(g.owner_id, name)
+        raise ExceptionalResponse.bad_request('Report name too long')
+    if report_being_deleted(g.owner_id, name):
+        raise ExceptionalResponse(ApiResponse(409, message='Report <%s> is being deleted, retry later' % name))
+    report = select_or_insert_report(g.owner_id, name)
     if not report:
-        return bad_request('Could not get report').get()
+        raise ExceptionalResponse.bad_request('Could not get report')
+    return report
 
-    if link:
+def _create_report_instance(report, input_string, opts):
+    """Create a report instance from the already checked input, returning the result
+    of :meth:`~mqe.reports.Report.process_input`"""
+    ip_options = {
+        'delimiter': opts['delimiter']
+    }
+
+    if opts['link']:
         extra_ri_data = {
-            'link': link,
+            'link': opts['link'],
         }
     else:
         extra_ri_data = None
 
-    ipres = report.process_input(input_string, tags=tags, created=created, input_type=input_type,
-                                 ip_options=ip_options, force_header=force_header, extra_ri_data=extra_ri_data)
-
+    def process(input_type):
+        with metrics.timed('process_input'):
+            return offload(report.process_input, input_string, tags=opts['tags'],
+                           created=opts['created'], input_type=input_type, ip_options=ip_options,
+                           force_header=opts['force_header'], extra_ri_data=extra_ri_data)
+
+    input_type = opts['input_type'] or 'any'
+    ipres = None
+    if input_type == 'any':
+        # try the input type which recently succeeded for the report before guessing
+        memo_input_type = input_type_memo.get(report.report_id)
+        if memo_input_type:
+            ipres = process(memo_input_type)
+            if ipres.report_instance is None:
+                input_type_memo.invalidate(report.report_id)
+                ipres = None
+
+    if ipres is None:
+        ipres = process(input_type)
+        if input_type == 'any' and ipres.report_instance is not None:
+            remember_input_type(report, ipres)
+
+    if ipres.report_instance is not None:
+        response_cache.invalidate(report.owner_id, report.report_name)
+        notify.hub.publish((report.owner_id, report.report_name))
+    return ipres
+
+def _process_input(report, name, input_string, opts):
+    """Create a report instance from the already checked input and return an
+    :class:`ApiResponse` describing it"""
+    ipres = _create_report_instance(report, input_string, opts)
+
+    input_type = opts['input_type'] or 'any'
     if ipres.report_instance is None:
         message = 'Cannot parse input'
         if input_type != 'any':
             message += ' using format %s' % input_type
-        return ApiResponse(400, message=message).get()
+        return ApiResponse(400, message=message)
 
     return ApiResponse(200, result=_report_instance_desc(
-        name, ipres.report_instance, True, False)).get()
+        name, ipres.report_instance, True, False))
 
+@bp_api.route('/reports/<name>', methods=['POST'])
+def post_report_instance(name):
+    form_key = request.args.get('formKey')
+    if form_key:
+        input_string = request.form.get(form_key)
+    else:
+        input_string = compression.request_data()
+
+    opts = _parse_input_options(request.args)
+    opts['input_type'] = opts['input_type'] or format_from_headers() or 'any'
+
+    _check_input(input_string, opts)
+    report = _select_or_insert_report(name)
+
+    async = parse_bool(request.args.get('async'))
+    if async is None:
+        async = apiconfig.ASYNC_INGEST_DEFAULT
+    if async:
+        return _enqueue_input(report, name, input_string, opts).get()
+
+    return _process_input(report, name, input_string, opts).get()
+
+
+def _process_queued_input(report, name, input_string, opts):
+    ipres = _create_report_instance(report, input_string, opts)
+    if ipres.report_instance is None:
+        log.warn('Cannot parse queued input for report %s (format %s)', name,
+                 opts['input_type'] or 'any')
+
+def _enqueue_input(report, name, input_string, opts):
+    # the creation datetime is fixed when the input is accepted, not when it's processed
+    if opts['created'] is None:
+        opts['created'] = datetime.datetime.utcnow()
+    try:
+        ingest_queue.submit(_process_queued_input, report, name, input_string, opts)
+    except Queue.Full:
+        return service_unavailable('Too many queued inputs, retry later',
+                                   apiconfig.ASYNC_INGEST_RETRY_AFTER)
+
+    r = ApiResponse(202, success=True)
+    r.result = OrderedDict([('created', opts['created'].isoformat()),
+                            ('tags', opts['tags'] or [])])
+    r.set_detail('queueDepth', ingest_queue.queue.qsize())
+    return r
+
+
+def _batch_items(data):
+    """Parse the body of a batch request - either a JSON array or newline-delimited
+    JSON documents (one item per line)"""
+    if not data or data.isspace():
+        raise ExceptionalResponse.bad_request('Empty batch')
+    data = data.strip()
+    if data.startswith('['):
+        try:
+            return serialize.json_loads(data)
+        except:
+            raise ExceptionalResponse.bad_request('Invalid JSON array')
+    items = []
+    for i, line in enumerate(data.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            items.append(serialize.json_loads(line))
+        except:
+            raise ExceptionalResponse.bad_request('Invalid JSON in line %s' % (i + 1))
+    return items
+
+def _item_param(value):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return u','.join(unicode(v) for v in value)
+    return unicode(value)
+
+def _process_batch_item(report, name, item, defaults):
+    """Create a report instance from a batch item and return an :class:`ApiResponse`.
+    An item is either an input string or an object with the key ``input`` and optional
+    keys named as the query parameters of ``POST /reports/<name>``, overriding ``defaults``."""
+    try:
+        if isinstance(item, basestring):
+            item = {'input': item}
+        if not isinstance(item, dict):
+            raise ExceptionalResponse.bad_request('A batch item must be an object or a string')
+
+        params = dict(defaults)
+        for k in INPUT_OPTION_KEYS:
+            if k in item:
+                params[k] = _item_param(item[k])
+
+        input_string = item.get('input')
+        if input_string is not None and not isinstance(input_string, basestring):
+            input_string = json.dumps(input_string)
+            if not params.get('format'):
+                params['format'] = 'json'
+
+        opts = _parse_input_options(params)
+        _check_input(input_string, opts)
+        return _process_input(report, name, input_string, opts)
+    except ExceptionalResponse as e:
+        return e.response
+    except Exception:
+        # the preceding items are already created, the error is reported for the item only
+        log.exception('Error when processing a batch item')
+        return ApiResponse(500, message='Internal error')
+
+@bp_api.route('/reports/<name>/batch', methods=['POST'])
+def post_report_instances_batch(name):
+    items = _batch_items(compression.request_data())
+    if not isinstance(items, list):
+        return bad_request('Batch must be a JSON array or newline-delimited JSON').get()
+    if len(items) > apiconfig.MAX_BATCH_ITEMS:
+        return bad_request('Too many batch items, maximum is %s' % apiconfig.MAX_BATCH_ITEMS).get()
+
+    defaults = dict((k, request.args.get(k)) for k in INPUT_OPTION_KEYS)
+    report = _select_or_insert_report(name)
+
+    results = [_process_batch_item(report, name, item, defaults) for item in items]
+    r = ApiResponse(200, result=[res.envelope() for res in results])
+    r.set_detail('created', sum(1 for res in results if res.success))
+    r.set_detail('failed', sum(1 for res in results if not res.success))
+    return r.get()
+
+
+def _ingest_line(line, reports_by_name, defaults):
+    """Process a single line of an ingest request. Return a pair (report name, :class:`ApiResponse`)."""
+    name = None
+    try:
+        try:
+            item = serialize.json_loads(line)
+        except:
+            raise ExceptionalResponse.bad_request('Invalid JSON')
+        if not isinstance(item, dict):
+            raise ExceptionalResponse.bad_request('A line must contain a JSON object')
+        name = item.get('report')
+        if not name or not isinstance(name, basestring):
+            raise ExceptionalResponse.bad_request('Missing report name')
+
+        if name not in reports_by_name:
+            try:
+                reports_by_name[name] = _select_or_insert_report(name)
+            except ExceptionalResponse as e:
+                reports_by_name[name] = e
+        report = reports_by_name[name]
+        if isinstance(report, ExceptionalResponse):
+            raise report
+
+        return name, _process_batch_item(report, name, item, defaults)
+    except ExceptionalResponse as e:
+        return name, e.response
+    except Exception:
+        log.exception('Error when ingesting a line')
+        return name, ApiResponse(500, message='Internal error')
+
+@bp_api.route('/ingest', methods=['POST'])
+def post_ingest():
+    defaults = dict((k, request.args.get(k)) for k in INPUT_OPTION_KEYS)
+    compression.request_content_encoding()
+
+    def generate():
+        reports_by_name = {}
+        item_count = 0
+        try:
+            for i, line in enumerate(compression.request_lines()):
+                if not line.strip():
+                    continue
+                item_count += 1
+                d = OrderedDict([('line', i + 1)])
+                if item_count > apiconfig.MAX_BATCH_ITEMS:
+                    d.update(bad_request('Too many lines, maximum is %s' % apiconfig.MAX_BATCH_ITEMS).envelope())
+                    yield json_line(d)
+                    break
+                name, res = _ingest_line(line, reports_by_name, defaults)
+                d['report'] = name
+                d.update(res.envelope())
+                yield json_line(d)
+        except ExceptionalResponse as e:
+            # an error of reading the request body
+            yield json_line(e.response.envelope())
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@bp_api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')